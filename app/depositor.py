@@ -1,90 +1,359 @@
-"""Polling worker that credits deposits from RPC wallets."""
+"""Worker that credits deposits from RPC wallets, on wallet notifications or by polling."""
 from __future__ import annotations
 
 import logging
 import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeout
+from dataclasses import dataclass
 from decimal import Decimal
+from typing import Dict, Iterable, Iterator, List, Tuple
 
 import click
 from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 
 from . import create_app
-from .database import db_session
-from .models import Address, CompletedOrder
+from .database import db_session, get_redis_client
+from .models import Address, CompletedOrder, DepositCursor, PendingDeposit
 from .rpc import WalletError
 from .services import accounts
+from .services.notify import Notification, fetch_notifications, push_notification
 
 logger = logging.getLogger(__name__)
 
 
-def _process_currency(registry, settings, currency_code: str) -> None:
-    currency = settings.currency(currency_code)
+LOOKUP_CHUNK = 500
+
+
+@dataclass(slots=True)
+class _Credit:
+    user_id: int
+    amount: int
+    txid: str
+    address: str
+
+
+def _chunks(values: Iterable[str]) -> Iterator[List[str]]:
+    values = list(values)
+    for start in range(0, len(values), LOOKUP_CHUNK):
+        yield values[start : start + LOOKUP_CHUNK]
+
+
+def _credited(currency_code: str, txids: Iterable[str]) -> set[Tuple[str, str]]:
+    """Return the ``(txid, address)`` deposits of the currency already credited from ``txids``.
+
+    Deposits credited before addresses were recorded have no address and
+    stand for their whole transaction.
+    """
+    credited: set[Tuple[str, str]] = set()
+    for chunk in _chunks(txids):
+        credited.update(
+            db_session.execute(
+                select(CompletedOrder.transaction_id, CompletedOrder.deposit_address).where(
+                    CompletedOrder.is_deposit.is_(True),
+                    CompletedOrder.base_currency == currency_code,
+                    CompletedOrder.transaction_id.in_(chunk),
+                )
+            ).tuples()
+        )
+    return credited
+
+
+def _address_owners(currency_code: str, addresses: Iterable[str]) -> Dict[str, int]:
+    owners: Dict[str, int] = {}
+    for chunk in _chunks(addresses):
+        owners.update(
+            db_session.execute(
+                select(Address.address, Address.user_id).where(
+                    Address.currency == currency_code, Address.address.in_(chunk)
+                )
+            ).all()
+        )
+    return owners
+
+
+def _apply_credits(currency_code: str, credits: List[_Credit]) -> None:
+    """Add the balance changes and deposit rows of ``credits`` to the current transaction."""
+    totals: Dict[int, int] = {}
+    for credit in credits:
+        totals[credit.user_id] = totals.get(credit.user_id, 0) + credit.amount
+    changes = [accounts.BalanceChange(user_id, currency_code, amount) for user_id, amount in totals.items()]
+    accounts.apply_balance_changes(changes, commit=False, create_missing=True)
+    db_session.add_all(
+        CompletedOrder(
+            user_id=credit.user_id,
+            instrument=f"{currency_code}_{currency_code}",
+            side="DEPOSIT",
+            base_currency=currency_code,
+            quote_currency=currency_code,
+            amount=credit.amount,
+            price=Decimal("0"),
+            is_deposit=True,
+            deposit_address=credit.address,
+            transaction_id=credit.txid,
+        )
+        for credit in credits
+    )
+
+
+@dataclass(slots=True)
+class _Fetch:
+    """Wallet data gathered for one poll of a currency, before any SQL is touched."""
+
+    listing: dict
+    details: Dict[str, dict]
+
+
+def _poll_inputs(currency_code: str) -> Tuple[str | None, List[str]]:
+    """Return the block cursor and pending txids a poll of ``currency_code`` starts from."""
+    cursor = db_session.get(DepositCursor, currency_code)
+    pending = db_session.execute(
+        select(PendingDeposit.transaction_id).where(PendingDeposit.currency == currency_code)
+    ).scalars()
+    return (cursor.block_hash if cursor else None), list(pending)
+
+
+def _fetch(registry, currency_code: str, block_hash: str | None, pending_txids: List[str]) -> _Fetch:
+    """Make the poll's RPC calls; safe to run off the main thread as it never touches SQL."""
+    details: Dict[str, dict] = {}
+    if pending_txids:
+        try:
+            details = registry.get_transactions(currency_code, pending_txids)
+        except WalletError as exc:
+            logger.warning("Unable to check pending %s deposits: %s", currency_code, exc)
     try:
-        transactions = registry.get_transaction_list(currency_code)
+        listing = registry.list_since_block(currency_code, block_hash)
     except WalletError as exc:
         logger.warning("Unable to fetch transactions for %s: %s", currency_code, exc)
-        return
-    known_txs = {
-        tx_id
-        for (tx_id,) in db_session.execute(
-            select(CompletedOrder.transaction_id).where(CompletedOrder.transaction_id.isnot(None))
-        )
-    }
-    for tx in transactions:
-        if tx.get("category") != "receive":
-            continue
-        if tx.get("confirmations", 0) < currency.min_confirmations:
+        listing = {}
+    return _Fetch(listing, details)
+
+
+def _process_currency(registry, settings, currency_code: str) -> None:
+    """Poll ``currency_code`` and credit what it found, all on the calling thread."""
+    _credit_poll(settings, currency_code, _fetch(registry, currency_code, *_poll_inputs(currency_code)))
+
+
+def _receives(listing: dict, multiplier: int) -> Dict[Tuple[str, str], Tuple[int, int]]:
+    """Sum the listed receives per ``(txid, address)`` into ``(amount units, confirmations)``.
+
+    A transaction can pay several deposit addresses, and even the same one
+    more than once, so every output is counted.
+    """
+    receives: Dict[Tuple[str, str], Tuple[int, int]] = {}
+    for tx in listing.get("transactions", []):
+        if tx.get("category") != "receive" or not tx.get("txid") or not tx.get("address"):
             continue
-        txid = tx.get("txid")
-        if not txid or txid in known_txs:
+        key = (tx["txid"], tx["address"])
+        amount, _ = receives.get(key, (0, 0))
+        amount += int(Decimal(str(tx.get("amount", 0))) * multiplier)
+        receives[key] = (amount, tx.get("confirmations", 0))
+    return receives
+
+
+def _credit_poll(settings, currency_code: str, fetch: _Fetch) -> None:
+    """Credit the receives listed since the currency's stored block cursor.
+
+    Receives short of the currency's confirmations are recorded once in
+    ``pending_deposits`` and re-checked by txid on later polls, so the cursor
+    can follow the chain tip.  Every credit of a poll is committed together
+    with the new cursor, and the unique deposit index rejects a transaction
+    output to an address that was already credited, so a crashed or
+    overlapping poll never credits twice.
+    """
+    currency = settings.currency(currency_code)
+    pending = db_session.execute(select(PendingDeposit).where(PendingDeposit.currency == currency_code)).scalars().all()
+    details, listing = fetch.details, fetch.listing
+    cursor = db_session.get(DepositCursor, currency_code)
+    receives = _receives(listing, currency.multiplier)
+    seen = _credited(
+        currency_code, {deposit.transaction_id for deposit in pending} | {txid for txid, _ in receives}
+    )
+    owners = _address_owners(currency_code, {address for _, address in receives})
+
+    credits: List[_Credit] = []
+    for deposit in pending:
+        seen.add((deposit.transaction_id, deposit.address))
+        tx = details.get(deposit.transaction_id)
+        if tx is None:
             continue
-        address = tx.get("address")
-        if not address:
+        confirmations = tx.get("confirmations", 0)
+        if confirmations < 0:
+            logger.info("Dropping conflicted %s deposit %s", currency_code.upper(), deposit.transaction_id)
+            db_session.delete(deposit)
+        elif confirmations >= currency.min_confirmations:
+            db_session.delete(deposit)
+            credits.append(_Credit(deposit.user_id, deposit.amount, deposit.transaction_id, deposit.address))
+        else:
+            deposit.confirmations = confirmations
+    for (txid, address), (amount_units, confirmations) in receives.items():
+        if (txid, address) in seen or (txid, None) in seen:
             continue
-        address_entry = db_session.execute(
-            select(Address).where(Address.currency == currency_code, Address.address == address)
-        ).scalar_one_or_none()
-        if not address_entry:
+        user_id = owners.get(address)
+        if user_id is None:
             logger.info("Skipping deposit for unknown address %s", address)
             continue
-        user = address_entry.user
-        amount_units = int(Decimal(str(tx.get("amount", 0))) * currency.multiplier)
         if amount_units <= 0:
             continue
-        accounts.change_balance(user, currency_code, amount_units)
-        order = CompletedOrder(
-            user_id=user.id,
-            instrument=f"{currency_code}_{currency_code}",
-            side="DEPOSIT",
-            base_currency=currency_code,
-            quote_currency=currency_code,
-            amount=amount_units,
-            price=Decimal("0"),
-            is_deposit=True,
-            transaction_id=txid,
-        )
-        db_session.add(order)
+        if confirmations < currency.min_confirmations:
+            db_session.add(
+                PendingDeposit(
+                    user_id=user_id,
+                    currency=currency_code,
+                    address=address,
+                    amount=amount_units,
+                    confirmations=confirmations,
+                    transaction_id=txid,
+                )
+            )
+        else:
+            credits.append(_Credit(user_id, amount_units, txid, address))
+
+    _apply_credits(currency_code, credits)
+    last_block = listing.get("lastblock")
+    if last_block:
+        if cursor is None:
+            cursor = DepositCursor(currency=currency_code, block_hash=last_block)
+            db_session.add(cursor)
+        cursor.block_hash = last_block
+    try:
         db_session.commit()
+    except IntegrityError as exc:
+        db_session.rollback()
+        logger.warning("Discarded %s poll that repeated a credited deposit: %s", currency_code, exc)
+        return
+    for credit in credits:
         logger.info(
-            "Credited %s %s to user %s", currency_code.upper(), Decimal(amount_units) / currency.multiplier, user.id
+            "Credited %s %s to user %s", currency_code.upper(), Decimal(credit.amount) / currency.multiplier, credit.user_id
         )
 
 
+def _collect(settings, inflight: Dict[str, Future], deadline: float) -> None:
+    """Credit each fetch in ``inflight`` as it completes, waiting at most ``deadline`` seconds.
+
+    Fetches still running stay in ``inflight`` and are credited by a later
+    call once their daemon responds, so one slow wallet never delays the
+    others and never has two fetches in flight.
+    """
+    futures = {future: code for code, future in inflight.items()}
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            code = futures[future]
+            del inflight[code]
+            try:
+                fetch = future.result()
+            except Exception:  # pragma: no cover - unexpected wallet client failure
+                logger.exception("Polling %s failed", code)
+                continue
+            _credit_poll(settings, code, fetch)
+    except FuturesTimeout:
+        logger.warning("Still waiting on %s wallets", ", ".join(sorted(inflight)))
+
+
+def _poll_all(
+    registry,
+    settings,
+    executor: ThreadPoolExecutor,
+    inflight: Dict[str, Future],
+    deadline: float,
+    currencies: Iterable[str] | None = None,
+) -> None:
+    """Fetch every currency (or ``currencies``) concurrently and credit each one as its wallet answers."""
+    for code in settings.currencies if currencies is None else currencies:
+        if code not in inflight:
+            inflight[code] = executor.submit(_fetch, registry, code, *_poll_inputs(code))
+    _collect(settings, inflight, deadline)
+
+
+def _fetch_notified(registry, currency_code: str, txids: List[str]) -> _Fetch:
+    """Look up the transactions named by ``walletnotify``; like :func:`_fetch` it never touches SQL."""
+    try:
+        transactions = registry.get_transactions(currency_code, txids)
+    except WalletError as exc:
+        logger.warning("Unable to fetch notified %s transactions: %s", currency_code, exc)
+        transactions = {}
+    receives = [
+        {
+            "category": "receive",
+            "txid": txid,
+            "address": detail.get("address"),
+            "amount": detail.get("amount", 0),
+            "confirmations": tx.get("confirmations", 0),
+        }
+        for txid, tx in transactions.items()
+        for detail in tx.get("details", [])
+        if detail.get("category") == "receive"
+    ]
+    # No lastblock: the cursor is left for the reconciliation polls.
+    return _Fetch({"transactions": receives}, {})
+
+
+def _handle_notifications(
+    registry,
+    settings,
+    executor: ThreadPoolExecutor,
+    inflight: Dict[str, Future],
+    deadline: float,
+    notifications: List[Notification],
+) -> None:
+    """Poll the currencies that saw a new block and credit the notified transactions of the others.
+
+    Both kinds of lookup run on the wallet threads and share ``inflight``
+    with the reconciliation polls.  Txids of a currency whose wallet is still
+    busy go back onto the notification queue.
+    """
+    blocks: set[str] = set()
+    txids: Dict[str, List[str]] = {}
+    for notification in notifications:
+        if notification.currency not in settings.currencies:
+            logger.warning("Ignoring notification for unknown currency %s", notification.currency)
+        elif notification.txid is None:
+            blocks.add(notification.currency)
+        elif notification.txid not in txids.setdefault(notification.currency, []):
+            txids[notification.currency].append(notification.txid)
+    for code, pending in txids.items():
+        if code in blocks:
+            # A poll lists every new transaction and re-checks pending ones, covering the txids too.
+            continue
+        if code in inflight:
+            # The running fetch may predate these transactions, so retry them once it is collected.
+            logger.info("%s wallet is still busy; requeueing %d notified txids", code, len(pending))
+            for txid in pending:
+                push_notification(get_redis_client(), Notification(code, txid))
+            continue
+        inflight[code] = executor.submit(_fetch_notified, registry, code, pending)
+    for code in sorted(blocks):
+        if code not in inflight:
+            inflight[code] = executor.submit(_fetch, registry, code, *_poll_inputs(code))
+    _collect(settings, inflight, deadline)
+
+
 @click.command()
-@click.option("--interval", type=int, default=30, help="Polling interval in seconds")
+@click.option("--interval", type=int, default=30, help="Seconds between full reconciliation polls")
+@click.option("--deadline", type=float, default=10.0, help="Seconds to wait for each currency's wallet per poll")
 @click.option("--once", is_flag=True, help="Process a single iteration and exit")
-def main(interval: int, once: bool) -> None:
+def main(interval: int, deadline: float, once: bool) -> None:
     app = create_app()
     with app.app_context():
         registry = app.extensions["wallet_registry"]
         settings = app.extensions["settings"]
         logger.info("Starting deposit processor")
-        while True:
-            for code in settings.currencies.keys():
-                _process_currency(registry, settings, code)
-            if once:
-                break
-            time.sleep(interval)
+        redis = get_redis_client()
+        inflight: Dict[str, Future] = {}
+        next_poll = 0.0
+        with ThreadPoolExecutor(max_workers=len(settings.currencies), thread_name_prefix="wallet") as executor:
+            while True:
+                if time.monotonic() >= next_poll:
+                    _poll_all(registry, settings, executor, inflight, deadline)
+                    next_poll = time.monotonic() + interval
+                    if once:
+                        break
+                # Wait for walletnotify/blocknotify hooks until the next reconciliation poll is due.
+                wait = max(1, int(next_poll - time.monotonic()))
+                notifications = fetch_notifications(redis, timeout=wait)
+                if notifications:
+                    _handle_notifications(registry, settings, executor, inflight, deadline, notifications)
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -10,10 +10,12 @@ from sqlalchemy import (
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     Numeric,
     String,
     UniqueConstraint,
+    text,
 )
 from sqlalchemy.orm import relationship
 
@@ -95,6 +97,19 @@ class Address(Base, TimestampMixin):
 
 class CompletedOrder(Base, TimestampMixin):
     __tablename__ = "completed_orders"
+    __table_args__ = (
+        # Withdrawals paid in one transaction share its id, and one transaction
+        # can pay several deposit addresses, so deposits are unique per address.
+        Index(
+            "uq_deposit_transaction",
+            "base_currency",
+            "transaction_id",
+            "deposit_address",
+            unique=True,
+            sqlite_where=text("is_deposit"),
+            postgresql_where=text("is_deposit"),
+        ),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -107,6 +122,8 @@ class CompletedOrder(Base, TimestampMixin):
     is_deposit = Column(Boolean, default=False, nullable=False)
     is_withdrawal = Column(Boolean, default=False, nullable=False)
     withdrawal_address = Column(String(128))
+    withdrawal_batch_id = Column(Integer, ForeignKey("withdrawal_batches.id"))
+    deposit_address = Column(String(128))
     transaction_id = Column(String(128))
 
     user = relationship("User", back_populates="orders")
@@ -114,3 +131,62 @@ class CompletedOrder(Base, TimestampMixin):
     @property
     def price_decimal(self) -> Decimal:
         return Decimal(self.price)
+
+
+class PendingDeposit(Base, TimestampMixin):
+    """Receive to a user's address that has not reached the currency's confirmations yet."""
+
+    __tablename__ = "pending_deposits"
+    __table_args__ = (
+        UniqueConstraint("currency", "transaction_id", "address", name="uq_pending_currency_tx"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    currency = Column(String(10), nullable=False)
+    address = Column(String(128), nullable=False)
+    amount = Column(BigInteger, nullable=False)
+    confirmations = Column(Integer, default=0, nullable=False)
+    transaction_id = Column(String(128), nullable=False)
+
+
+class WithdrawalBatch(Base, TimestampMixin):
+    """Withdrawals of one currency paid out together with a single ``sendmany``.
+
+    ``status`` moves from ``open`` to ``sending`` right before the payment is
+    submitted and to ``sent`` once its ``transaction_id`` is recorded.  A
+    batch the wallet refuses to pay ends ``failed`` and its withdrawals move
+    on to batches of their own or are refunded.
+    """
+
+    __tablename__ = "withdrawal_batches"
+
+    id = Column(Integer, primary_key=True)
+    currency = Column(String(10), nullable=False)
+    status = Column(String(10), default="open", nullable=False)
+    transaction_id = Column(String(128))
+
+    withdrawals = relationship("CompletedOrder")
+
+    @property
+    def comment(self) -> str:
+        """Wallet comment that identifies the batch's payment."""
+        return f"withdrawal-batch:{self.id}"
+
+
+class SettlementCheckpoint(Base, TimestampMixin):
+    """Last settlement journal entry applied to SQL for an instrument."""
+
+    __tablename__ = "settlement_checkpoints"
+
+    instrument = Column(String(15), primary_key=True)
+    journal_id = Column(String(32), nullable=False)
+
+
+class DepositCursor(Base, TimestampMixin):
+    """Block hash the depositor passes to ``listsinceblock`` for a currency."""
+
+    __tablename__ = "deposit_cursors"
+
+    currency = Column(String(10), primary_key=True)
+    block_hash = Column(String(64), nullable=False)
@@ -0,0 +1,32 @@
+"""Hook for ``walletnotify``/``blocknotify`` that queues work for the depositor.
+
+Configure the daemons with, for example::
+
+    walletnotify=python -m app.notify ltc --tx %s
+    blocknotify=python -m app.notify ltc --block %s
+"""
+from __future__ import annotations
+
+import click
+
+from .database import init_redis_client
+from .services.notify import Notification, push_notification
+from .settings import get_settings
+
+
+@click.command()
+@click.argument("currency")
+@click.option("--tx", "txid", help="Wallet transaction id passed by walletnotify")
+@click.option("--block", "block_hash", help="Block hash passed by blocknotify")
+def main(currency: str, txid: str | None, block_hash: str | None) -> None:
+    settings = get_settings()
+    currency = currency.lower()
+    if currency not in settings.currencies:
+        raise click.BadParameter(f"Unknown currency '{currency}'", param_hint="CURRENCY")
+    if bool(txid) == bool(block_hash):
+        raise click.UsageError("Pass exactly one of --tx or --block")
+    push_notification(init_redis_client(settings.redis_url), Notification(currency, txid))
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
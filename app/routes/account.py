@@ -30,6 +30,7 @@ def index():
         "account/index.html",
         balances=balances,
         addresses=addresses,
+        pending=accounts.get_pending_deposits(user),
         currencies=settings.currencies,
         history=history,
         history_currency=history_currency,
@@ -75,8 +76,12 @@ def withdraw():
     if amount_units <= 0:
         flash("Amount must be greater than zero", "danger")
         return redirect(url_for("account.index"))
+    minimum = settings.currency(currency).min_withdrawal
+    if amount_units < minimum:
+        flash(f"The minimum withdrawal is {Decimal(minimum) / multiplier} {currency.upper()}", "danger")
+        return redirect(url_for("account.index"))
     try:
-        accounts.change_balance(user, currency, -amount_units)
+        accounts.change_balance(user, currency, -amount_units, commit=False)
     except accounts.AccountError as exc:
         flash(str(exc), "danger")
         return redirect(url_for("account.index"))
@@ -1,14 +1,29 @@
 """JSON API endpoints."""
 from __future__ import annotations
 
-from flask import Blueprint, abort, jsonify
+import json
+import re
+import time
+from typing import Callable
+
+from flask import Blueprint, Response, abort, current_app, jsonify, request
+from redis.exceptions import RedisError
 
 from ..database import get_redis_client
+from ..services.cache import cached, get_version
+from ..services.depth import read_depth_snapshot
+from ..services.events import read_events
+from ..services.market import CANDLE_INTERVALS, read_candles
 from ..services.orders import OrderBook
 from .helpers import get_settings
 
 blueprint = Blueprint("api", __name__, url_prefix="/api")
 
+MAX_CANDLES = 1000
+MAX_DEPTH_LEVELS = 500
+MAX_TRADES = 500
+STREAM_BLOCK_MS = 15_000
+
 
 def _validate_instrument(instrument: str) -> str:
     settings = get_settings()
@@ -17,25 +32,49 @@ def _validate_instrument(instrument: str) -> str:
     return instrument
 
 
+def _versioned_json(instrument: str, name: str, build: Callable[[], object]):
+    """Serve ``build()`` from the cache for the instrument's current version.
+
+    The version doubles as the ETag, so pollers get a 304 until the worker
+    publishes a change.
+    """
+    redis = get_redis_client()
+    try:
+        version = get_version(redis, instrument)
+    except RedisError:
+        return jsonify(build())
+    etag = f"{instrument}-{version}"
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        try:
+            body = cached(redis, instrument, version, name, lambda: current_app.json.dumps(build()))
+        except RedisError:
+            body = current_app.json.dumps(build())
+        response = current_app.response_class(body, mimetype="application/json")
+    response.set_etag(etag)
+    return response
+
+
 @blueprint.route("/volume/<instrument>")
 def volume(instrument: str):
     instrument = _validate_instrument(instrument)
     order_book = OrderBook(get_redis_client(), get_settings())
-    return jsonify(order_book.get_volume(instrument))
+    return _versioned_json(instrument, "volume", lambda: order_book.get_volume(instrument))
 
 
 @blueprint.route("/high/<instrument>")
 def high(instrument: str):
     instrument = _validate_instrument(instrument)
     order_book = OrderBook(get_redis_client(), get_settings())
-    return jsonify({"high": order_book.get_high(instrument)})
+    return _versioned_json(instrument, "high", lambda: {"high": order_book.get_high(instrument)})
 
 
 @blueprint.route("/low/<instrument>")
 def low(instrument: str):
     instrument = _validate_instrument(instrument)
     order_book = OrderBook(get_redis_client(), get_settings())
-    return jsonify({"low": order_book.get_low(instrument)})
+    return _versioned_json(instrument, "low", lambda: {"low": order_book.get_low(instrument)})
 
 
 @blueprint.route("/orders/<instrument>/<side>")
@@ -44,4 +83,136 @@ def orders(instrument: str, side: str):
     if side not in {"bid", "ask"}:
         abort(400, description="Side must be 'bid' or 'ask'")
     order_book = OrderBook(get_redis_client(), get_settings())
-    return jsonify(order_book.list_orders(instrument, side))
+    return _versioned_json(instrument, f"orders:{side}", lambda: order_book.list_orders(instrument, side))
+
+
+@blueprint.route("/depth/<instrument>")
+def depth(instrument: str):
+    instrument = _validate_instrument(instrument)
+    levels = _depth_levels()
+    order_book = OrderBook(get_redis_client(), get_settings())
+
+    def build():
+        book = order_book.get_depth(instrument, levels)
+        return {"bids": book["bid"], "asks": book["ask"]}
+
+    return _versioned_json(instrument, f"depth:{levels}", build)
+
+
+@blueprint.route("/trades/<instrument>")
+def trades(instrument: str):
+    """Latest trades, newest first; pass the returned ``next`` as ``before`` for older ones."""
+    instrument = _validate_instrument(instrument)
+    limit = request.args.get("limit", 100, type=int)
+    if not 1 <= limit <= MAX_TRADES:
+        abort(400, description=f"Limit must be between 1 and {MAX_TRADES}")
+    before = request.args.get("before") or None
+    if before is not None and not re.fullmatch(r"\d+-\d+", before):
+        abort(400, description="Invalid cursor")
+    order_book = OrderBook(get_redis_client(), get_settings())
+    return _versioned_json(
+        instrument, f"trades:{limit}:{before or ''}", lambda: order_book.get_trades(instrument, limit, before)
+    )
+
+
+def _depth_levels() -> int:
+    levels = request.args.get("levels", 50, type=int)
+    if not 1 <= levels <= MAX_DEPTH_LEVELS:
+        abort(400, description=f"Levels must be between 1 and {MAX_DEPTH_LEVELS}")
+    return levels
+
+
+def _sse(event: str, seq: int, data: object) -> str:
+    return f"event: {event}\nid: {seq}\ndata: {json.dumps(data)}\n\n"
+
+
+@blueprint.route("/stream/<instrument>")
+def stream(instrument: str):
+    """Server-sent events: a depth snapshot followed by sequenced updates.
+
+    Each update's ``id`` is the book version it produces.  Clients that
+    reconnect with ``Last-Event-ID`` resume after that version; a gap in the
+    sequence (the event stream was trimmed) or a reset event sends a fresh
+    snapshot instead.
+    """
+    instrument = _validate_instrument(instrument)
+    levels = _depth_levels()
+    spec = get_settings().instrument(instrument)
+    redis = get_redis_client()
+    last_event_id = request.headers.get("Last-Event-ID", type=int)
+
+    def snapshot():
+        seq, book = read_depth_snapshot(redis, instrument, levels)
+        data = {
+            "seq": seq,
+            **{
+                name: [{"price": spec.to_float(price), "amount": quantity / spec.base_multiplier} for price, quantity in book[side]]
+                for name, side in (("bids", "bid"), ("asks", "ask"))
+            },
+        }
+        return seq, _sse("snapshot", seq, data)
+
+    def generate():
+        seq = last_event_id
+        if seq is None:
+            seq, message = snapshot()
+            yield message
+        while True:
+            events = read_events(redis, instrument, seq, block_ms=STREAM_BLOCK_MS)
+            if not events:
+                yield ": keep-alive\n\n"
+                continue
+            for event in events:
+                if event.reset or event.seq != seq + 1:
+                    seq, message = snapshot()
+                    yield message
+                    break
+                seq = event.seq
+                yield _sse(
+                    "update",
+                    seq,
+                    {
+                        "seq": seq,
+                        "levels": [
+                            {"side": side, "price": spec.to_float(price), "amount": quantity / spec.base_multiplier}
+                            for side, price, quantity in event.levels
+                        ],
+                        "trades": [
+                            {"time": at, "side": side, "price": spec.to_float(price), "amount": amount / spec.base_multiplier}
+                            for at, side, price, amount in event.trades
+                        ],
+                    },
+                )
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@blueprint.route("/candles/<instrument>")
+def candles(instrument: str):
+    instrument = _validate_instrument(instrument)
+    interval = request.args.get("interval", "1h")
+    if interval not in CANDLE_INTERVALS:
+        abort(400, description=f"Interval must be one of {', '.join(CANDLE_INTERVALS)}")
+    end = request.args.get("to", type=int) or int(time.time())
+    start = request.args.get("from", type=int)
+    if start is None:
+        start = end - CANDLE_INTERVALS[interval] * MAX_CANDLES
+    spec = get_settings().instrument(instrument)
+    return jsonify(
+        [
+            {
+                "time": candle.start,
+                "open": spec.to_float(candle.open),
+                "high": spec.to_float(candle.high),
+                "low": spec.to_float(candle.low),
+                "close": spec.to_float(candle.close),
+                "base_currency_volume": candle.base / spec.base_multiplier,
+                "quote_currency_volume": candle.quote / spec.quote_multiplier,
+            }
+            for candle in read_candles(get_redis_client(), instrument, interval, start, end, MAX_CANDLES)
+        ]
+    )
@@ -4,8 +4,9 @@ from __future__ import annotations
 from functools import wraps
 from typing import Callable, TypeVar
 
-from flask import current_app, flash, redirect, session, url_for
+from flask import current_app, flash, g, redirect, session, url_for
 from sqlalchemy import select
+from sqlalchemy.orm import selectinload
 
 from ..database import db_session
 from ..models import User
@@ -20,18 +21,30 @@ def get_settings() -> Settings:
 
 
 def get_current_user() -> User | None:
+    """Return the logged-in user, loaded once per request with balances and addresses."""
     user_id = session.get("user_id")
     if not user_id:
         return None
-    return db_session.execute(select(User).where(User.id == user_id)).scalar_one_or_none()
+    cached = g.get("current_user")
+    if cached is not None and cached[0] == user_id:
+        return cached[1]
+    user = db_session.execute(
+        select(User)
+        .options(selectinload(User.balances), selectinload(User.addresses))
+        .where(User.id == user_id)
+    ).scalar_one_or_none()
+    g.current_user = (user_id, user)
+    return user
 
 
 def login_user(user: User) -> None:
     session["user_id"] = user.id
+    g.pop("current_user", None)
 
 
 def logout_user() -> None:
     session.pop("user_id", None)
+    g.pop("current_user", None)
 
 
 def login_required(func: F) -> F:
@@ -2,14 +2,19 @@
 from __future__ import annotations
 
 from flask import Blueprint, render_template, request
+from markupsafe import Markup
+from redis.exceptions import RedisError
 
 from ..database import get_redis_client
 from ..forms import OrderForm
+from ..services.cache import cached, get_version
 from ..services.orders import OrderBook
 from .helpers import get_current_user, get_settings
 
 blueprint = Blueprint("home", __name__)
 
+HOME_DEPTH_LEVELS = 20
+
 
 def _instrument_from_request() -> str:
     settings = get_settings()
@@ -21,11 +26,33 @@ def _instrument_from_request() -> str:
     return settings.trading_pairs[0]
 
 
+def _market_fragment(settings, instrument: str) -> Markup:
+    """Render the public stats and book card, shared across users and processes per book version."""
+    redis = get_redis_client()
+    order_book = OrderBook(redis, settings)
+
+    def render() -> str:
+        depth = order_book.get_depth(instrument, HOME_DEPTH_LEVELS)
+        return render_template(
+            "home/_market.html",
+            instrument=instrument,
+            stats=order_book.get_ticker(instrument),
+            bids=depth["bid"],
+            asks=depth["ask"],
+            trading_pairs=settings.trading_pairs,
+        )
+
+    try:
+        html = cached(redis, instrument, get_version(redis, instrument), "home:market", render)
+    except RedisError:
+        html = render()
+    return Markup(html)
+
+
 @blueprint.route("/")
 def index():
     settings = get_settings()
     instrument = _instrument_from_request()
-    order_book = OrderBook(get_redis_client(), settings)
     form = OrderForm()
     form.instrument.choices = [(pair, pair.upper()) for pair in settings.trading_pairs]
     form.instrument.data = instrument
@@ -34,13 +61,6 @@ def index():
         "home/index.html",
         instrument=instrument,
         form=form,
-        stats={
-            "volume": order_book.get_volume(instrument),
-            "high": order_book.get_high(instrument),
-            "low": order_book.get_low(instrument),
-        },
-        bids=order_book.list_orders(instrument, "bid"),
-        asks=order_book.list_orders(instrument, "ask"),
-        trading_pairs=settings.trading_pairs,
+        market=_market_fragment(settings, instrument),
         user=user,
     )
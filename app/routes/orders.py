@@ -41,9 +41,12 @@ def place_order():
         flash("Amount must be greater than zero", "danger")
         return redirect(url_for("home.index", pair=instrument))
 
-    base_multiplier = Decimal(settings.currency(base_currency).multiplier)
-    quote_multiplier = Decimal(settings.currency(quote_currency).multiplier)
-    quote_total = int((Decimal(amount_units) / base_multiplier * price * quote_multiplier).quantize(Decimal(1)))
+    spec = settings.instrument(instrument)
+    price_ticks = spec.to_ticks(price)
+    if price_ticks <= 0:
+        flash("Price is too small", "danger")
+        return redirect(url_for("home.index", pair=instrument))
+    quote_total = spec.quote_units(amount_units, price_ticks)
     if quote_total <= 0:
         flash("Order total is too small", "danger")
         return redirect(url_for("home.index", pair=instrument))
@@ -64,7 +67,7 @@ def place_order():
         id=secrets.token_hex(16),
         instrument=instrument,
         side=side,
-        price=price,
+        price=spec.to_price(price_ticks),
         amount=amount_units,
         user_id=user.id,
     )
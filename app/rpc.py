@@ -1,28 +1,123 @@
 """Simple JSON-RPC wallet helpers."""
 from __future__ import annotations
 
-from dataclasses import dataclass
-from typing import Dict
+import asyncio
+import http.client
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from decimal import Decimal
+from typing import Dict, Iterator, List, Sequence, Tuple
 
+from bitcoinrpc.asyncproxy import AsyncServiceProxy
 from bitcoinrpc.authproxy import AuthServiceProxy, JSONRPCException
 
 from .settings import CurrencySettings, Settings
 
+POOL_SIZE = 4
+
+# Raised when a kept-alive connection was closed by the daemon since its last use.
+_STALE_ERRORS = (http.client.HTTPException, ConnectionError)
+_ASYNC_ERRORS = (JSONRPCException, OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError)
+
 
 class WalletError(RuntimeError):
     pass
 
 
+class WalletRejected(WalletError):
+    """The daemon answered the call with an error, so it had no effect."""
+
+    def __init__(self, message: str, code: int | None = None) -> None:
+        super().__init__(message)
+        self.code = code
+
+
+def _batch_results(responses, count: int) -> List[object]:
+    """Order batch ``responses`` by id; entries answered with an error become WalletError."""
+    if not isinstance(responses, list):
+        # The daemon rejected the whole batch (bad credentials, malformed request).
+        raise WalletError(str(responses.get("error") if isinstance(responses, dict) else responses))
+    results: List[object] = [WalletError("missing JSON-RPC response")] * count
+    for response in responses:
+        error = response.get("error")
+        results[response["id"]] = WalletError(str(error)) if error is not None else response.get("result")
+    return results
+
+
 @dataclass(slots=True)
 class Wallet:
+    """A wallet daemon and a pool of kept-alive connections to it.
+
+    Connections are checked out by one thread at a time and returned after a
+    successful call; a call that fails on a connection the daemon has since
+    closed is retried once on a fresh one when ``retry`` allows it.
+    """
+
     code: str
     name: str
     rpc_url: str
     timeout: int
+    _idle: List[AuthServiceProxy] = field(default_factory=list, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+    _async: AsyncServiceProxy | None = field(default=None, repr=False)
 
     def client(self) -> AuthServiceProxy:
         return AuthServiceProxy(self.rpc_url, timeout=self.timeout)
 
+    def async_client(self) -> AsyncServiceProxy:
+        """Return the wallet's asyncio client; its connections belong to one event loop."""
+        if self._async is None:
+            self._async = AsyncServiceProxy(self.rpc_url, timeout=self.timeout, max_connections=POOL_SIZE)
+        return self._async
+
+    @contextmanager
+    def _connection(self, fresh: bool = False) -> Iterator[AuthServiceProxy]:
+        proxy = None
+        if not fresh:
+            with self._lock:
+                if self._idle:
+                    proxy = self._idle.pop()
+        if proxy is None:
+            proxy = self.client()
+        yield proxy
+        # Only reached when the call succeeded, so broken connections are dropped.
+        with self._lock:
+            if len(self._idle) < POOL_SIZE:
+                self._idle.append(proxy)
+
+    def call(self, method: str, *params, retry: bool = True):
+        try:
+            with self._connection() as proxy:
+                return getattr(proxy, method)(*params)
+        except _STALE_ERRORS:
+            if not retry:
+                raise
+        with self._connection(fresh=True) as proxy:
+            return getattr(proxy, method)(*params)
+
+    def call_many(self, calls: Sequence[Tuple[str, Sequence]], retry: bool = True) -> List[object]:
+        """Send ``calls`` as one JSON-RPC batch and return the results in order.
+
+        An entry the daemon answered with an error holds a :class:`WalletError`
+        instead of a result.
+        """
+        if not calls:
+            return []
+        payload = [
+            {"version": "1.1", "method": method, "params": list(params), "id": index}
+            for index, (method, params) in enumerate(calls)
+        ]
+        try:
+            with self._connection() as proxy:
+                responses = proxy._batch(payload)
+        except _STALE_ERRORS:
+            if not retry:
+                raise
+            with self._connection(fresh=True) as proxy:
+                responses = proxy._batch(payload)
+        return _batch_results(responses, len(calls))
+
 
 class WalletRegistry:
     """Provides access to configured JSON-RPC wallets."""
@@ -44,22 +139,121 @@ class WalletRegistry:
         except KeyError as exc:  # pragma: no cover - sanity check
             raise WalletError(f"Currency '{currency}' is not configured") from exc
 
-    def get_new_address(self, currency: str, label: str | None = None) -> str:
+    def _call(self, currency: str, method: str, *params, retry: bool = True):
         try:
-            if label is None:
-                label = f"echanger-{currency}"
-            return self.wallet(currency).client().getnewaddress(label)
+            return self.wallet(currency).call(method, *params, retry=retry)
         except JSONRPCException as exc:  # pragma: no cover - network call
+            code = exc.error.get("code") if isinstance(exc.error, dict) else None
+            raise WalletRejected(str(exc.error), code) from exc
+        except (http.client.HTTPException, OSError) as exc:  # pragma: no cover - network call
             raise WalletError(str(exc)) from exc
 
-    def get_transaction_list(self, currency: str) -> list[dict]:
+    def call_many(self, currency: str, calls: Sequence[Tuple[str, Sequence]], retry: bool = True) -> List[object]:
+        """Run ``calls`` (``(method, params)`` pairs) in one request; failed entries hold a WalletError."""
         try:
-            return self.wallet(currency).client().listtransactions()
-        except JSONRPCException as exc:  # pragma: no cover - network call
+            return self.wallet(currency).call_many(calls, retry=retry)
+        except (JSONRPCException, http.client.HTTPException, OSError, ValueError) as exc:  # pragma: no cover - network call
             raise WalletError(str(exc)) from exc
 
-    def send_to_address(self, currency: str, address: str, amount: float) -> str:
+    async def call_async(self, currency: str, method: str, *params, retry: bool = True):
         try:
-            return self.wallet(currency).client().sendtoaddress(address, amount)
-        except JSONRPCException as exc:  # pragma: no cover - network call
+            return await self.wallet(currency).async_client().call(method, *params, retry=retry)
+        except _ASYNC_ERRORS as exc:  # pragma: no cover - network call
+            raise WalletError(str(exc)) from exc
+
+    async def call_many_async(self, currency: str, calls: Sequence[Tuple[str, Sequence]], retry: bool = True) -> List[object]:
+        """Like :meth:`call_many`, on the event loop."""
+        payload = [
+            {"version": "1.1", "method": method, "params": list(params), "id": index}
+            for index, (method, params) in enumerate(calls)
+        ]
+        if not payload:
+            return []
+        try:
+            responses = await self.wallet(currency).async_client().batch(payload, retry=retry)
+        except _ASYNC_ERRORS as exc:  # pragma: no cover - network call
             raise WalletError(str(exc)) from exc
+        return _batch_results(responses, len(calls))
+
+    async def close_async(self) -> None:
+        """Close the idle asyncio connections before their event loop ends."""
+        for wallet in self._wallets.values():
+            if wallet._async is not None:
+                await wallet._async.close()
+                wallet._async = None
+
+    async def get_new_address_async(self, currency: str, label: str | None = None) -> str:
+        return await self.call_async(currency, "getnewaddress", label or f"echanger-{currency}")
+
+    async def list_since_block_async(
+        self, currency: str, block_hash: str | None = None, target_confirmations: int = 1
+    ) -> dict:
+        return await self.call_async(currency, "listsinceblock", block_hash or "", target_confirmations)
+
+    async def get_transactions_async(self, currency: str, txids: list[str]) -> dict[str, dict]:
+        results = await self.call_many_async(currency, [("gettransaction", [txid]) for txid in txids])
+        return {txid: result for txid, result in zip(txids, results) if isinstance(result, dict)}
+
+    async def send_to_address_async(self, currency: str, address: str, amount: float) -> str:
+        return await self.call_async(currency, "sendtoaddress", address, amount, retry=False)
+
+    def get_new_address(self, currency: str, label: str | None = None) -> str:
+        if label is None:
+            label = f"echanger-{currency}"
+        return self._call(currency, "getnewaddress", label)
+
+    def get_transaction_list(self, currency: str) -> list[dict]:
+        return self._call(currency, "listtransactions")
+
+    def list_since_block(self, currency: str, block_hash: str | None = None, target_confirmations: int = 1) -> dict:
+        """Return wallet transactions after ``block_hash`` and the ``lastblock`` to resume from.
+
+        ``lastblock`` is the block ``target_confirmations`` deep; with the
+        default of 1 it is the chain tip.
+        """
+        return self._call(currency, "listsinceblock", block_hash or "", target_confirmations)
+
+    def get_transactions(self, currency: str, txids: list[str]) -> dict[str, dict]:
+        """Fetch ``gettransaction`` for every txid in one batched request.
+
+        Transactions the wallet reports an error for are left out.
+        """
+        results = self.call_many(currency, [("gettransaction", [txid]) for txid in txids])
+        return {txid: result for txid, result in zip(txids, results) if isinstance(result, dict)}
+
+    def send_many(self, currency: str, amounts: Dict[str, Decimal], comment: str) -> str:
+        """Pay every address in ``amounts`` with one ``sendmany`` transaction and return its txid.
+
+        Like any payment it is never retried; look it up by ``comment`` with
+        :meth:`find_sent_transaction` when the outcome is unknown.
+        """
+        return self._call(currency, "sendmany", "", amounts, 1, comment, retry=False)
+
+    def find_sent_transaction(self, currency: str, comment: str, since: float, page_size: int = 200) -> str | None:
+        """Return the txid of a payment sent with ``comment``, if the wallet has one.
+
+        ``listtransactions`` is paged back from the newest transaction until
+        it reaches ones older than ``since`` (Unix time), so a busy wallet
+        cannot push the payment out of view.
+        """
+        skip = 0
+        while True:
+            page = self._call(currency, "listtransactions", "*", page_size, skip)
+            for tx in page:
+                if tx.get("category") == "send" and tx.get("comment") == comment:
+                    return tx["txid"]
+            if len(page) < page_size or min(tx.get("time", 0) for tx in page) < since:
+                return None
+            skip += page_size
+
+    def validate_addresses(self, currency: str, addresses: List[str]) -> Dict[str, bool]:
+        """Check ``addresses`` with one batched ``validateaddress`` request."""
+        results = self.call_many(currency, [("validateaddress", [address]) for address in addresses])
+        return {
+            address: isinstance(result, dict) and bool(result.get("isvalid"))
+            for address, result in zip(addresses, results)
+        }
+
+    def send_to_address(self, currency: str, address: str, amount: float) -> str:
+        # A payment whose connection dropped may still have been sent, so it is never retried.
+        return self._call(currency, "sendtoaddress", address, amount, retry=False)
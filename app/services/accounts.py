@@ -4,11 +4,11 @@ from __future__ import annotations
 from dataclasses import dataclass
 from typing import Dict, Iterable, List
 
-from sqlalchemy import select
+from sqlalchemy import bindparam, func, select, update
 from werkzeug.security import check_password_hash, generate_password_hash
 
 from ..database import db_session
-from ..models import Address, CompletedOrder, User, WalletBalance
+from ..models import Address, CompletedOrder, PendingDeposit, User, WalletBalance
 from ..settings import Settings
 
 
@@ -25,6 +25,13 @@ class BalanceView:
         return f"{self.balance / multiplier:.8f}"
 
 
+@dataclass(slots=True)
+class BalanceChange:
+    user_id: int
+    currency: str
+    delta: int
+
+
 def ensure_user_balances(user: User, currencies: Iterable[str]) -> None:
     existing = {balance.currency for balance in user.balances}
     for currency in currencies:
@@ -47,18 +54,81 @@ def authenticate_user(email: str, password: str) -> User | None:
     return None
 
 
-def change_balance(user: User, currency: str, delta: int) -> WalletBalance:
-    for balance in user.balances:
-        if balance.currency == currency:
-            if balance.balance + delta < 0:
-                raise AccountError(
-                    f"Insufficient balance for {currency}: {balance.balance} + {delta}",
+_balances = WalletBalance.__table__
+
+_CREDIT = (
+    update(_balances)
+    .where(_balances.c.user_id == bindparam("b_user_id"), _balances.c.currency == bindparam("b_currency"))
+    .values(balance=_balances.c.balance + bindparam("b_delta"))
+)
+_DEBIT = _CREDIT.where(_balances.c.balance + bindparam("b_delta") >= 0)
+
+
+def _params(change: BalanceChange) -> Dict[str, object]:
+    return {"b_user_id": change.user_id, "b_currency": change.currency, "b_delta": change.delta}
+
+
+def _existing_balances(changes: List[BalanceChange]) -> set[tuple[int, str]]:
+    user_ids = {change.user_id for change in changes}
+    rows = db_session.execute(
+        select(WalletBalance.user_id, WalletBalance.currency).where(WalletBalance.user_id.in_(user_ids))
+    )
+    return {(user_id, currency) for user_id, currency in rows}
+
+
+def apply_balance_changes(
+    changes: Iterable[BalanceChange], commit: bool = True, create_missing: bool = False
+) -> List[BalanceChange]:
+    """Apply ``changes`` as guarded ``balance = balance + delta`` updates.
+
+    Credits are sent as a single executemany; debits are applied one by one
+    and only when they leave the balance non-negative.  Returns the changes
+    that were rejected, either because the balance row does not exist or
+    because the debit exceeds it.  With ``create_missing`` a credit to a
+    missing row adds the row instead of being rejected.  Accepted changes
+    stay applied even when others are rejected, so callers that need
+    all-or-nothing semantics should roll back.
+    """
+    changes = [change for change in changes if change.delta]
+    credits = [change for change in changes if change.delta > 0]
+    debits = [change for change in changes if change.delta < 0]
+    rejected: List[BalanceChange] = []
+    if credits:
+        result = db_session.execute(_CREDIT, [_params(change) for change in credits])
+        if result.rowcount != len(credits):
+            existing = _existing_balances(credits)
+            missing = [change for change in credits if (change.user_id, change.currency) not in existing]
+            if create_missing:
+                db_session.add_all(
+                    WalletBalance(user_id=change.user_id, currency=change.currency, balance=change.delta)
+                    for change in missing
                 )
-            balance.balance += delta
-            db_session.add(balance)
-            db_session.commit()
-            return balance
-    raise AccountError(f"Unknown currency '{currency}' for user {user.id}")
+            else:
+                rejected.extend(missing)
+    for change in debits:
+        if db_session.execute(_DEBIT, _params(change)).rowcount == 0:
+            rejected.append(change)
+    # The updates bypass the ORM, so refresh any balances it already loaded.
+    touched = {(change.user_id, change.currency) for change in changes}
+    for instance in list(db_session.identity_map.values()):
+        if isinstance(instance, WalletBalance) and (instance.user_id, instance.currency) in touched:
+            db_session.expire(instance, ["balance"])
+    if commit:
+        db_session.commit()
+    return rejected
+
+
+def change_balance(user: User, currency: str, delta: int, commit: bool = True) -> None:
+    """Adjust ``user``'s balance by ``delta`` units.
+
+    Pass ``commit=False`` to leave the change in the current transaction so
+    several updates can be committed together.
+    """
+    if not apply_balance_changes([BalanceChange(user.id, currency, delta)], commit=commit):
+        return
+    if currency not in {balance.currency for balance in user.balances}:
+        raise AccountError(f"Unknown currency '{currency}' for user {user.id}")
+    raise AccountError(f"Insufficient balance for {currency}: {user.balance_for(currency)} + {delta}")
 
 
 def get_balance_view(user: User, settings: Settings) -> List[BalanceView]:
@@ -100,6 +170,17 @@ def set_deposit_address(user: User, currency: str, address: str, label: str | No
     return entry
 
 
+def get_pending_deposits(user: User) -> Dict[str, int]:
+    """Return the unconfirmed deposit total per currency in smallest units."""
+    return dict(
+        db_session.execute(
+            select(PendingDeposit.currency, func.sum(PendingDeposit.amount))
+            .where(PendingDeposit.user_id == user.id)
+            .group_by(PendingDeposit.currency)
+        ).all()
+    )
+
+
 def get_trade_history(user: User, currency: str) -> List[CompletedOrder]:
     return list(
         db_session.execute(
@@ -0,0 +1,33 @@
+"""Per-instrument versions and the response cache shared by web processes.
+
+Versions are bumped by :func:`app.services.events.publish_update`.
+"""
+from __future__ import annotations
+
+from typing import Callable
+
+from redis import Redis
+
+CACHE_TTL_SECONDS = 60
+
+
+def version_key(instrument: str) -> str:
+    return f"{instrument}/version"
+
+
+def get_version(redis: Redis, instrument: str) -> int:
+    return int(redis.get(version_key(instrument)) or 0)
+
+
+def cached(redis: Redis, instrument: str, version: int, name: str, build: Callable[[], str]) -> str:
+    """Return the body cached for ``name`` at ``version``, building it on a miss.
+
+    Versions are read before the data they describe, so a body built after
+    a concurrent change is never older than the version it is cached under.
+    """
+    key = f"cache:{instrument}:{version}:{name}"
+    body = redis.get(key)
+    if body is None:
+        body = build()
+        redis.set(key, body, ex=CACHE_TTL_SECONDS)
+    return body
@@ -0,0 +1,79 @@
+"""Aggregated order-book depth: resting quantity per price level."""
+from __future__ import annotations
+
+from typing import Dict, Iterable, List, Tuple
+
+from redis import Redis
+
+from .cache import version_key
+from .matching import MatchingEngine
+
+DEPTH_READ_SCRIPT = """
+-- KEYS: bid hash, bid levels, ask hash, ask levels, version; ARGV[1]: number of levels
+local function side(quantities, levels, command)
+  local out = {}
+  for _, price in ipairs(redis.call(command, levels, 0, tonumber(ARGV[1]) - 1)) do
+    out[#out + 1] = price
+    out[#out + 1] = redis.call('HGET', quantities, price) or '0'
+  end
+  return out
+end
+return {side(KEYS[1], KEYS[2], 'ZREVRANGE'), side(KEYS[3], KEYS[4], 'ZRANGE'), redis.call('GET', KEYS[5]) or '0'}
+"""
+
+Levels = List[Tuple[int, int]]
+
+
+def book_side(side: str) -> str:
+    """Map an order side (``buy``/``sell``) to its book side key suffix."""
+    return "bid" if side == "buy" else "ask"
+
+
+def depth_key(instrument: str, side: str) -> str:
+    return f"{instrument}/depth:{side}"
+
+
+def depth_levels_key(instrument: str, side: str) -> str:
+    return f"{instrument}/depth:{side}:levels"
+
+
+def read_depth_snapshot(redis: Redis, instrument: str, levels: int) -> Tuple[int, Dict[str, Levels]]:
+    """Return the instrument's version with the best ``levels`` bid and ask levels.
+
+    Both are read by one script, so the levels reflect exactly the updates
+    up to that version.
+    """
+    script = redis.register_script(DEPTH_READ_SCRIPT)
+    bids, asks, version = script(
+        keys=[
+            depth_key(instrument, "bid"),
+            depth_levels_key(instrument, "bid"),
+            depth_key(instrument, "ask"),
+            depth_levels_key(instrument, "ask"),
+            version_key(instrument),
+        ],
+        args=[levels],
+    )
+    return int(version), {
+        side: [(int(flat[index]), int(flat[index + 1])) for index in range(0, len(flat), 2)]
+        for side, flat in (("bid", bids), ("ask", asks))
+    }
+
+
+def read_depth(redis: Redis, instrument: str, levels: int) -> Dict[str, Levels]:
+    """Return the best ``levels`` bid and ask levels as ``(price, quantity)`` in one round trip."""
+    return read_depth_snapshot(redis, instrument, levels)[1]
+
+
+def rebuild_depth(redis: Redis, engine: MatchingEngine, instruments: Iterable[str]) -> None:
+    """Replace the depth index of ``instruments`` with the levels of a loaded book."""
+    pipe = redis.pipeline()
+    for instrument in instruments:
+        book = engine.book(instrument)
+        for side, levels in (("bid", book.bids), ("ask", book.asks)):
+            quantities = {level.price: level.quantity for level in levels.levels() if level.quantity > 0}
+            pipe.delete(depth_key(instrument, side), depth_levels_key(instrument, side))
+            if quantities:
+                pipe.hset(depth_key(instrument, side), mapping=quantities)
+                pipe.zadd(depth_levels_key(instrument, side), {str(price): price for price in quantities})
+    pipe.execute()
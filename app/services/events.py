@@ -0,0 +1,111 @@
+"""Sequenced market-data events: book level changes and trades per instrument."""
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass, field
+from typing import Iterable, List, Tuple
+
+from redis import Redis
+
+from .cache import version_key
+from .depth import depth_key, depth_levels_key
+
+EVENTS_MAXLEN = 10_000
+
+UPDATE_SCRIPT = """
+-- Apply depth changes, bump the version and append the matching event.
+-- KEYS: bid hash, bid levels, ask hash, ask levels, version, events stream
+-- ARGV: events to keep, trades JSON, reset flag, then side/price/delta triples
+local levels = {}
+for i = 4, #ARGV, 3 do
+  local quantities, index = KEYS[1], KEYS[2]
+  if ARGV[i] == 'ask' then
+    quantities, index = KEYS[3], KEYS[4]
+  end
+  local quantity = redis.call('HINCRBY', quantities, ARGV[i + 1], ARGV[i + 2])
+  if quantity <= 0 then
+    redis.call('HDEL', quantities, ARGV[i + 1])
+    redis.call('ZREM', index, ARGV[i + 1])
+    quantity = 0
+  else
+    redis.call('ZADD', index, ARGV[i + 1], ARGV[i + 1])
+  end
+  levels[#levels + 1] = ARGV[i] .. ':' .. ARGV[i + 1] .. ':' .. quantity
+end
+local seq = redis.call('INCR', KEYS[5])
+redis.call('XADD', KEYS[6], 'MAXLEN', '~', ARGV[1], seq .. '-0',
+  'levels', table.concat(levels, ','), 'trades', ARGV[2], 'reset', ARGV[3])
+return seq
+"""
+
+DepthChange = Tuple[str, int, int]
+
+
+def events_key(instrument: str) -> str:
+    return f"{instrument}/events"
+
+
+@dataclass(slots=True)
+class MarketEvent:
+    """One version of an instrument: the levels it changed and the trades it added.
+
+    ``levels`` holds ``(side, price, quantity)`` with the new absolute
+    quantity, ``trades`` holds ``(time, side, price, amount)``.  ``reset``
+    events tell subscribers to fetch a new snapshot.
+    """
+
+    seq: int
+    levels: List[Tuple[str, int, int]] = field(default_factory=list)
+    trades: List[Tuple[int, str, int, int]] = field(default_factory=list)
+    reset: bool = False
+
+
+def publish_update(
+    client,
+    instrument: str,
+    depth: Iterable[DepthChange] = (),
+    trades: Iterable[Tuple[int, str, int, int]] = (),
+    reset: bool = False,
+) -> None:
+    """Apply ``depth`` changes (``(bid|ask, price, delta)``) and publish them as the next version.
+
+    Every version bump goes through here, so event sequence numbers equal
+    versions and have no gaps.  ``client`` may be a pipeline.
+    """
+    args: List[object] = [EVENTS_MAXLEN, json.dumps(list(trades)), int(reset)]
+    for side, price, delta in depth:
+        args.extend((side, price, delta))
+    script = client.register_script(UPDATE_SCRIPT)
+    script(
+        keys=[
+            depth_key(instrument, "bid"),
+            depth_levels_key(instrument, "bid"),
+            depth_key(instrument, "ask"),
+            depth_levels_key(instrument, "ask"),
+            version_key(instrument),
+            events_key(instrument),
+        ],
+        args=args,
+        client=client,
+    )
+
+
+def read_events(redis: Redis, instrument: str, after: int, block_ms: int | None = None, count: int = 100) -> List[MarketEvent]:
+    """Return the events following version ``after``, oldest first."""
+    response = redis.xread({events_key(instrument): f"{after}-0"}, count=count, block=block_ms)
+    events: List[MarketEvent] = []
+    for _, entries in response or []:
+        for entry_id, fields in entries:
+            levels = []
+            for level in filter(None, fields.get("levels", "").split(",")):
+                side, price, quantity = level.split(":")
+                levels.append((side, int(price), int(quantity)))
+            events.append(
+                MarketEvent(
+                    seq=int(entry_id.split("-")[0]),
+                    levels=levels,
+                    trades=[tuple(trade) for trade in json.loads(fields.get("trades") or "[]")],
+                    reset=fields.get("reset") == "1",
+                )
+            )
+    return events
@@ -0,0 +1,226 @@
+"""Worker-resident settlement cache with a Redis journal for crash recovery."""
+from __future__ import annotations
+
+import json
+import logging
+import time
+from datetime import datetime, timezone
+from dataclasses import dataclass, field
+from typing import Dict, List, Set, Tuple
+
+from redis import Redis
+from sqlalchemy import insert, select
+
+from ..database import db_session
+from ..models import CompletedOrder, SettlementCheckpoint, User
+from ..settings import Settings
+from .accounts import BalanceChange, apply_balance_changes
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class TradeRecord:
+    user_id: int
+    instrument: str
+    side: str
+    amount: int
+    price: int
+    executed_at: float
+
+
+@dataclass(slots=True)
+class Settlement:
+    """Balance changes and trades produced for one instrument."""
+
+    instrument: str
+    balances: Dict[Tuple[int, str], int] = field(default_factory=dict)
+    trades: List[TradeRecord] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.balances or self.trades)
+
+    def credit(self, user_id: int, currency: str, delta: int) -> None:
+        key = (user_id, currency)
+        self.balances[key] = self.balances.get(key, 0) + delta
+
+    def record(self, user_id: int, side: str, amount: int, price: int, executed_at: float) -> None:
+        """Add a trade executed at ``executed_at`` (Unix seconds) for ``user_id``."""
+        self.trades.append(TradeRecord(user_id, self.instrument, side, amount, price, executed_at))
+
+    def merge(self, other: "Settlement") -> None:
+        for (user_id, currency), delta in other.balances.items():
+            self.credit(user_id, currency, delta)
+        self.trades.extend(other.trades)
+
+    def dumps(self) -> str:
+        return json.dumps(
+            {
+                "balances": [[user_id, currency, delta] for (user_id, currency), delta in self.balances.items()],
+                "trades": [
+                    [trade.user_id, trade.side, trade.amount, trade.price, trade.executed_at] for trade in self.trades
+                ],
+            }
+        )
+
+    @classmethod
+    def loads(cls, instrument: str, data: str) -> "Settlement":
+        payload = json.loads(data)
+        settlement = cls(instrument)
+        for user_id, currency, delta in payload["balances"]:
+            settlement.credit(user_id, currency, delta)
+        for user_id, side, amount, price, *executed_at in payload["trades"]:
+            # Entries journalled before fill times were recorded fall back to the replay time.
+            settlement.record(user_id, side, amount, price, executed_at[0] if executed_at else time.time())
+        return settlement
+
+
+class SettlementLedger:
+    """Accumulates the worker's balance credits and trades between SQL flushes.
+
+    Every batch is appended to a per-instrument Redis journal
+    (``<instrument>/journal``) in the same transaction that publishes the
+    book, and pending changes are netted per ``(user_id, currency)``.  A flush
+    applies them to ``wallet_balances`` together with the trades and the last
+    journal id per instrument, so :meth:`recover` can replay exactly the
+    entries that never reached SQL.
+    """
+
+    def __init__(self, redis: Redis, settings: Settings, flush_interval_ms: int = 0) -> None:
+        self.redis = redis
+        self.settings = settings
+        self.flush_interval = flush_interval_ms / 1000
+        self._known_users: Set[int] = set()
+        self._batch: Dict[str, Settlement] = {}
+        self._pending: Dict[str, Settlement] = {}
+        self._checkpoints: Dict[str, str] = {}
+        self._last_flush = time.monotonic()
+
+    @staticmethod
+    def journal_key(instrument: str) -> str:
+        return f"{instrument}/journal"
+
+    @property
+    def has_pending(self) -> bool:
+        return bool(self._checkpoints)
+
+    def user_exists(self, user_id: int) -> bool:
+        if user_id in self._known_users:
+            return True
+        found = db_session.execute(select(User.id).where(User.id == user_id)).scalar_one_or_none()
+        if found is not None:
+            self._known_users.add(user_id)
+        return found is not None
+
+    def settlement(self, instrument: str) -> Settlement:
+        """Return the settlement collecting ``instrument``'s current batch."""
+        settlement = self._batch.get(instrument)
+        if settlement is None:
+            settlement = self._batch[instrument] = Settlement(instrument)
+        return settlement
+
+    def journal(self, pipe) -> Dict[str, int]:
+        """Queue the current batch on ``pipe`` and return each entry's result index."""
+        positions: Dict[str, int] = {}
+        for instrument, settlement in self._batch.items():
+            if settlement:
+                positions[instrument] = len(pipe)
+                pipe.xadd(self.journal_key(instrument), {"settlement": settlement.dumps()})
+        return positions
+
+    def commit_batch(self, positions: Dict[str, int], results: List) -> None:
+        """Move the journalled batch into the pending set awaiting a flush."""
+        for instrument, index in positions.items():
+            self._absorb(self._batch[instrument], results[index])
+        self._batch.clear()
+
+    def discard_batch(self) -> None:
+        self._batch.clear()
+
+    def _absorb(self, settlement: Settlement, journal_id: str) -> None:
+        pending = self._pending.get(settlement.instrument)
+        if pending is None:
+            pending = self._pending[settlement.instrument] = Settlement(settlement.instrument)
+        pending.merge(settlement)
+        self._checkpoints[settlement.instrument] = journal_id
+
+    def flush(self, force: bool = False) -> bool:
+        """Write pending changes to SQL when the flush interval has elapsed."""
+        if not self._checkpoints:
+            self._last_flush = time.monotonic()
+            return False
+        if not force and time.monotonic() - self._last_flush < self.flush_interval:
+            return False
+        balances: Dict[Tuple[int, str], int] = {}
+        for settlement in self._pending.values():
+            for key, delta in settlement.balances.items():
+                balances[key] = balances.get(key, 0) + delta
+        try:
+            self._apply_balances(balances)
+            self._insert_trades()
+            for instrument, journal_id in self._checkpoints.items():
+                db_session.merge(SettlementCheckpoint(instrument=instrument, journal_id=journal_id))
+            db_session.commit()
+        except Exception:
+            db_session.rollback()
+            raise
+        pipe = self.redis.pipeline(transaction=False)
+        for instrument, journal_id in self._checkpoints.items():
+            pipe.xtrim(self.journal_key(instrument), minid=journal_id)
+        pipe.execute()
+        self._pending.clear()
+        self._checkpoints.clear()
+        self._last_flush = time.monotonic()
+        return True
+
+    def _apply_balances(self, balances: Dict[Tuple[int, str], int]) -> None:
+        changes = [BalanceChange(user_id, currency, delta) for (user_id, currency), delta in balances.items()]
+        apply_balance_changes(changes, commit=False, create_missing=True)
+
+    def _insert_trades(self) -> None:
+        """Write every pending trade with one executemany, bypassing the ORM.
+
+        ``created_at`` is when the fill executed, not when the flush ran.
+        """
+        now = datetime.now(timezone.utc)
+        rows = []
+        for settlement in self._pending.values():
+            spec = self.settings.instrument(settlement.instrument)
+            rows.extend(
+                {
+                    "user_id": trade.user_id,
+                    "instrument": trade.instrument,
+                    "side": trade.side,
+                    "base_currency": spec.base_currency,
+                    "quote_currency": spec.quote_currency,
+                    "amount": trade.amount,
+                    "price": spec.to_price(trade.price),
+                    "is_deposit": False,
+                    "is_withdrawal": False,
+                    "created_at": datetime.fromtimestamp(trade.executed_at, timezone.utc),
+                    "updated_at": now,
+                }
+                for trade in settlement.trades
+            )
+        if rows:
+            db_session.execute(insert(CompletedOrder.__table__), rows)
+
+    def recover(self, instruments: List[str]) -> int:
+        """Apply journal entries that were published but never flushed to SQL."""
+        checkpoints = {
+            checkpoint.instrument: checkpoint.journal_id
+            for checkpoint in db_session.execute(
+                select(SettlementCheckpoint).where(SettlementCheckpoint.instrument.in_(instruments))
+            ).scalars()
+        }
+        replayed = 0
+        for instrument in instruments:
+            since = checkpoints.get(instrument)
+            entries = self.redis.xrange(self.journal_key(instrument), min=f"({since}" if since else "-")
+            for journal_id, fields in entries:
+                self._absorb(Settlement.loads(instrument, fields["settlement"]), journal_id)
+                replayed += 1
+        if replayed:
+            logger.warning("Replaying %s unsettled journal entries", replayed)
+            self.flush(force=True)
+        return replayed
@@ -0,0 +1,308 @@
+"""Market statistics maintained by the matching worker as fills happen."""
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Tuple
+
+from redis import Redis
+
+from .depth import book_side
+from .events import publish_update
+from .matching import Fill
+
+TICKER_WINDOW_MINUTES = 24 * 60
+CANDLE_INTERVALS = {"1m": 60, "5m": 300, "1h": 3600, "1d": 86400}
+TAPE_MAXLEN = 10_000
+
+
+def ticker_key(instrument: str) -> str:
+    return f"{instrument}/ticker"
+
+
+def ticker_bucket_key(instrument: str, minute: int) -> str:
+    return f"{instrument}/ticker:{minute}"
+
+
+def candle_key(instrument: str, interval: str) -> str:
+    return f"{instrument}/candles:{interval}"
+
+
+def trades_key(instrument: str) -> str:
+    return f"{instrument}/trades"
+
+
+def current_minute(now: float | None = None) -> int:
+    return int((time.time() if now is None else now) // 60)
+
+
+@dataclass(slots=True)
+class TickerStats:
+    """Traded volume in base and quote units and the price range in ticks."""
+
+    base: int = 0
+    quote: int = 0
+    high: int = 0
+    low: int = 0
+
+    def add(self, amount: int, quote: int, price: int) -> None:
+        self.merge(TickerStats(amount, quote, price, price))
+
+    def merge(self, other: "TickerStats") -> None:
+        if not other.base:
+            return
+        self.high = max(self.high, other.high) if self.base else other.high
+        self.low = min(self.low, other.low) if self.base else other.low
+        self.base += other.base
+        self.quote += other.quote
+
+    def to_mapping(self) -> Dict[str, int]:
+        return {"base": self.base, "quote": self.quote, "high": self.high, "low": self.low}
+
+    @classmethod
+    def from_mapping(cls, payload: Dict[str, str]) -> "TickerStats":
+        return cls(*(int(payload.get(name, 0)) for name in ("base", "quote", "high", "low")))
+
+
+def aggregate_ticker(redis: Redis, instrument: str, minute: int, window: int = TICKER_WINDOW_MINUTES) -> TickerStats:
+    """Sum the per-minute buckets of the window ending at ``minute``."""
+    pipe = redis.pipeline(transaction=False)
+    for bucket in range(minute - window + 1, minute + 1):
+        pipe.hgetall(ticker_bucket_key(instrument, bucket))
+    stats = TickerStats()
+    for payload in pipe.execute():
+        if payload:
+            stats.merge(TickerStats.from_mapping(payload))
+    return stats
+
+
+def read_ticker(redis: Redis, instrument: str, now: float | None = None) -> TickerStats:
+    """Return the rolling 24h stats published for ``instrument``.
+
+    The summary hash is kept current by the worker; if it has not been
+    refreshed for more than a minute (no worker running) the buckets are
+    summed instead so expired minutes never count.
+    """
+    minute = current_minute(now)
+    payload = redis.hgetall(ticker_key(instrument))
+    if payload and int(payload.get("minute", 0)) >= minute - 1:
+        return TickerStats.from_mapping(payload)
+    return aggregate_ticker(redis, instrument, minute)
+
+
+@dataclass(slots=True)
+class Candle:
+    """OHLC prices in ticks and volumes in units for one interval starting at ``start``."""
+
+    start: int
+    open: int
+    high: int
+    low: int
+    close: int
+    base: int
+    quote: int
+
+    @classmethod
+    def opening(cls, start: int, amount: int, quote: int, price: int) -> "Candle":
+        return cls(start, price, price, price, price, amount, quote)
+
+    def add(self, amount: int, quote: int, price: int) -> None:
+        self.high = max(self.high, price)
+        self.low = min(self.low, price)
+        self.close = price
+        self.base += amount
+        self.quote += quote
+
+    def encode(self) -> str:
+        return ":".join(str(value) for value in (self.start, self.open, self.high, self.low, self.close, self.base, self.quote))
+
+    @classmethod
+    def decode(cls, member: str) -> "Candle":
+        return cls(*(int(value) for value in member.split(":")))
+
+
+def read_candles(redis: Redis, instrument: str, interval: str, start: int, end: int, limit: int) -> List[Candle]:
+    """Return candles starting between ``start`` and ``end`` (Unix seconds), oldest first."""
+    members = redis.zrangebyscore(candle_key(instrument, interval), start, end, start=0, num=limit)
+    return [Candle.decode(member) for member in members]
+
+
+def build_candles(trades: Iterable[Tuple[int, int, int, int]]) -> Dict[str, List[Candle]]:
+    """Aggregate ``(timestamp, amount, quote_units, price_ticks)`` trades, oldest first."""
+    candles: Dict[str, List[Candle]] = {interval: [] for interval in CANDLE_INTERVALS}
+    for timestamp, amount, quote, price in trades:
+        for interval, seconds in CANDLE_INTERVALS.items():
+            start = timestamp - timestamp % seconds
+            series = candles[interval]
+            if series and series[-1].start == start:
+                series[-1].add(amount, quote, price)
+            else:
+                series.append(Candle.opening(start, amount, quote, price))
+    return candles
+
+
+def store_candles(redis: Redis, instrument: str, candles: Dict[str, List[Candle]]) -> None:
+    """Replace every stored candle of ``instrument`` with ``candles``."""
+    pipe = redis.pipeline()
+    for interval, series in candles.items():
+        key = candle_key(instrument, interval)
+        pipe.delete(key)
+        for start in range(0, len(series), 1000):
+            pipe.zadd(key, {candle.encode(): candle.start for candle in series[start : start + 1000]})
+    pipe.execute()
+
+
+@dataclass(slots=True)
+class Trade:
+    """One fill on the tape: taker ``side``, price in ticks and amount in units."""
+
+    id: str
+    time: int
+    side: str
+    price: int
+    amount: int
+
+
+def read_trades(redis: Redis, instrument: str, limit: int, before: str | None = None) -> List[Trade]:
+    """Return up to ``limit`` trades older than the tape entry ``before``, newest first."""
+    entries = redis.xrevrange(trades_key(instrument), max=f"({before}" if before else "+", count=limit)
+    return [
+        Trade(entry_id, int(fields["time"]), fields["side"], int(fields["price"]), int(fields["amount"]))
+        for entry_id, fields in entries
+    ]
+
+
+class MarketFeed:
+    """Rolling 24h ticker and candles per instrument, kept in the worker and published to Redis.
+
+    Fills are added to per-minute buckets (``<instrument>/ticker:<minute>``)
+    that expire once they leave the window, and the window's totals are
+    written to ``<instrument>/ticker`` whenever they change or a minute rolls
+    over, so readers fetch a single hash.  The open candle of every interval
+    is kept in memory and rewritten in ``<instrument>/candles:<interval>``
+    after each batch that trades, its fills are appended to the capped
+    ``<instrument>/trades`` tape, and the batch's depth changes are applied
+    once per price level.  Every instrument whose published data changed gets
+    one event with its level changes and trades, which also bumps its
+    version, in the same transaction.
+    """
+
+    def __init__(self, instruments: Iterable[str], window_minutes: int = TICKER_WINDOW_MINUTES) -> None:
+        self.window = window_minutes
+        self._buckets: Dict[str, Dict[int, TickerStats]] = {instrument: {} for instrument in instruments}
+        self._dirty: Dict[str, set[int]] = {instrument: set() for instrument in self._buckets}
+        self._published: Dict[str, int] = {}
+        self._summaries: Dict[str, TickerStats] = {}
+        self._candles: Dict[str, Dict[str, Candle]] = {instrument: {} for instrument in self._buckets}
+        self._dirty_candles: Dict[str, Dict[Tuple[str, int], Candle]] = {instrument: {} for instrument in self._buckets}
+        self._depth: Dict[str, Dict[Tuple[str, int], int]] = {instrument: {} for instrument in self._buckets}
+        self._trades: Dict[str, List[Tuple[int, str, int, int]]] = {instrument: [] for instrument in self._buckets}
+
+    def load(self, redis: Redis, now: float | None = None) -> None:
+        minute = current_minute(now)
+        for instrument, buckets in self._buckets.items():
+            pipe = redis.pipeline(transaction=False)
+            minutes = range(minute - self.window + 1, minute + 1)
+            for bucket in minutes:
+                pipe.hgetall(ticker_bucket_key(instrument, bucket))
+            for interval in CANDLE_INTERVALS:
+                pipe.zrange(candle_key(instrument, interval), -1, -1)
+            results = pipe.execute()
+            for bucket, payload in zip(minutes, results):
+                if payload:
+                    buckets[bucket] = TickerStats.from_mapping(payload)
+            for interval, latest in zip(CANDLE_INTERVALS, results[len(minutes) :]):
+                if latest:
+                    self._candles[instrument][interval] = Candle.decode(latest[0])
+
+    def record_fill(self, instrument: str, fill: Fill, quote_units: int, now: float | None = None) -> None:
+        """Add ``fill`` executed at ``now`` to the ticker, candles and tape.
+
+        Called once per fill, which matches the single ``buy`` row the ledger
+        stores for it at the same time, so ``backfill-candles`` rebuilds the
+        candles written here.
+        """
+        timestamp = int(time.time() if now is None else now)
+        minute = timestamp // 60
+        bucket = self._buckets[instrument].get(minute)
+        if bucket is None:
+            bucket = self._buckets[instrument][minute] = TickerStats()
+        bucket.add(fill.amount, quote_units, fill.price)
+        self._dirty[instrument].add(minute)
+        self._trades[instrument].append((timestamp, fill.side, fill.price, fill.amount))
+        candles = self._candles[instrument]
+        for interval, seconds in CANDLE_INTERVALS.items():
+            start = timestamp - timestamp % seconds
+            candle = candles.get(interval)
+            # A clock stepping backwards keeps adding to the open candle.
+            if candle is None or start > candle.start:
+                candle = candles[interval] = Candle.opening(start, fill.amount, quote_units, fill.price)
+            else:
+                candle.add(fill.amount, quote_units, fill.price)
+            # Keyed by start so a candle closed earlier in the batch is still written.
+            self._dirty_candles[instrument][(interval, candle.start)] = candle
+
+    def adjust_depth(self, instrument: str, side: str, price: int, delta: int) -> None:
+        """Queue a change of the resting quantity at ``price`` on ``side`` (``buy``/``sell``)."""
+        changes = self._depth[instrument]
+        key = (book_side(side), price)
+        changes[key] = changes.get(key, 0) + delta
+
+    def pending(self, now: float | None = None) -> bool:
+        minute = current_minute(now)
+        return any(self._dirty[instrument] or self._published.get(instrument) != minute for instrument in self._buckets)
+
+    def publish(self, pipe, now: float | None = None) -> set[str]:
+        """Queue changed depth, candles, buckets, summaries and events on ``pipe``.
+
+        Returns the instruments whose version was bumped.
+        """
+        minute = current_minute(now)
+        oldest = minute - self.window + 1
+        changed = {instrument for instrument, changes in self._depth.items() if any(changes.values())}
+        for instrument, dirty_candles in self._dirty_candles.items():
+            if dirty_candles:
+                changed.add(instrument)
+            for (interval, start), candle in dirty_candles.items():
+                key = candle_key(instrument, interval)
+                pipe.zremrangebyscore(key, start, start)
+                pipe.zadd(key, {candle.encode(): start})
+            dirty_candles.clear()
+        for instrument, buckets in self._buckets.items():
+            dirty = self._dirty[instrument]
+            if not dirty and self._published.get(instrument) == minute:
+                continue
+            for bucket in [bucket for bucket in buckets if bucket < oldest]:
+                del buckets[bucket]
+            for bucket in dirty:
+                if bucket < oldest:
+                    continue
+                key = ticker_bucket_key(instrument, bucket)
+                pipe.hset(key, mapping=buckets[bucket].to_mapping())
+                pipe.expireat(key, (bucket + self.window) * 60)
+            dirty.clear()
+            summary = TickerStats()
+            for stats in buckets.values():
+                summary.merge(stats)
+            pipe.hset(ticker_key(instrument), mapping={**summary.to_mapping(), "minute": minute})
+            self._published[instrument] = minute
+            # A minute rolling over only refreshes the summary's minute unless
+            # trades left the window, so idle instruments keep their version.
+            if summary != self._summaries.get(instrument):
+                self._summaries[instrument] = summary
+                changed.add(instrument)
+        for instrument, trades in self._trades.items():
+            for timestamp, side, price, amount in trades:
+                pipe.xadd(
+                    trades_key(instrument),
+                    {"time": timestamp, "side": side, "price": price, "amount": amount},
+                    maxlen=TAPE_MAXLEN,
+                    approximate=True,
+                )
+        for instrument in changed:
+            depth = [(side, price, delta) for (side, price), delta in self._depth[instrument].items() if delta]
+            publish_update(pipe, instrument, depth, self._trades[instrument])
+        for instrument in self._buckets:
+            self._depth[instrument].clear()
+            self._trades[instrument].clear()
+        return changed
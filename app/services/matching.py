@@ -0,0 +1,414 @@
+"""In-process price-level matching engine used by the order worker."""
+from __future__ import annotations
+
+import bisect
+from collections import deque
+from dataclasses import dataclass, field
+from decimal import Decimal
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Union
+
+from redis import Redis
+
+from ..settings import Settings
+
+
+@dataclass(slots=True)
+class RestingOrder:
+    id: str
+    instrument: str
+    side: str
+    price: int
+    amount: int
+    user_id: int
+
+
+@dataclass(slots=True)
+class Fill:
+    """A single execution between an incoming order and a resting one."""
+
+    taker_id: str
+    maker_id: str
+    taker_user_id: int
+    maker_user_id: int
+    side: str
+    price: int
+    amount: int
+    maker_remaining: int
+    maker_price: int
+
+
+@dataclass(slots=True)
+class MatchResult:
+    order: RestingOrder
+    fills: List[Fill] = field(default_factory=list)
+    dropped: List[RestingOrder] = field(default_factory=list)
+
+    @property
+    def remaining(self) -> int:
+        return self.order.amount
+
+
+@dataclass(slots=True)
+class PriceLevel:
+    price: int
+    orders: Deque[RestingOrder] = field(default_factory=deque)
+    quantity: int = 0
+
+    def append(self, order: RestingOrder) -> None:
+        self.orders.append(order)
+        self.quantity += order.amount
+
+
+class BookSide:
+    """One side of a book: price levels kept sorted with FIFO queues per level."""
+
+    def __init__(self, side: str) -> None:
+        self.side = side
+        self._prices: List[int] = []
+        self._levels: Dict[int, PriceLevel] = {}
+
+    def __len__(self) -> int:
+        return len(self._prices)
+
+    def best(self) -> Optional[PriceLevel]:
+        if not self._prices:
+            return None
+        price = self._prices[-1] if self.side == "buy" else self._prices[0]
+        return self._levels[price]
+
+    def levels(self) -> Iterator[PriceLevel]:
+        """Yield levels from the best price outwards."""
+        prices = reversed(self._prices) if self.side == "buy" else iter(self._prices)
+        for price in prices:
+            yield self._levels[price]
+
+    def add(self, order: RestingOrder) -> None:
+        level = self._levels.get(order.price)
+        if level is None:
+            level = PriceLevel(order.price)
+            self._levels[order.price] = level
+            bisect.insort(self._prices, order.price)
+        level.append(order)
+
+    def remove(self, order: RestingOrder) -> None:
+        level = self._levels[order.price]
+        level.orders.remove(order)
+        level.quantity -= order.amount
+        if not level.orders:
+            self._drop_level(level)
+
+    def _drop_level(self, level: PriceLevel) -> None:
+        del self._levels[level.price]
+        index = bisect.bisect_left(self._prices, level.price)
+        del self._prices[index]
+
+
+class InstrumentBook:
+    """Bid and ask price levels for a single trading pair."""
+
+    def __init__(self, instrument: str) -> None:
+        self.instrument = instrument
+        self.bids = BookSide("buy")
+        self.asks = BookSide("sell")
+        self._orders: Dict[str, RestingOrder] = {}
+
+    def __contains__(self, order_id: str) -> bool:
+        return order_id in self._orders
+
+    def _side(self, side: str) -> BookSide:
+        return self.bids if side == "buy" else self.asks
+
+    def get(self, order_id: str) -> Optional[RestingOrder]:
+        return self._orders.get(order_id)
+
+    def add(self, order: RestingOrder) -> None:
+        self._orders[order.id] = order
+        self._side(order.side).add(order)
+
+    def remove(self, order_id: str) -> Optional[RestingOrder]:
+        order = self._orders.pop(order_id, None)
+        if order is not None:
+            self._side(order.side).remove(order)
+        return order
+
+    def match(
+        self,
+        order: RestingOrder,
+        accept: Callable[[RestingOrder], bool] | None = None,
+    ) -> MatchResult:
+        """Match ``order`` against the opposite side and rest any remainder.
+
+        Buy orders execute at their own limit price while sell orders execute
+        at the resting bid price, mirroring how funds are escrowed when the
+        order is placed.  ``accept`` may reject resting orders (for example
+        when their owner no longer exists); rejected orders are dropped from
+        the book and reported in :attr:`MatchResult.dropped`.
+        """
+        self.remove(order.id)
+        result = MatchResult(order=order)
+        opposite = self.asks if order.side == "buy" else self.bids
+        while order.amount > 0:
+            level = opposite.best()
+            if level is None:
+                break
+            if order.side == "buy" and level.price > order.price:
+                break
+            if order.side == "sell" and level.price < order.price:
+                break
+            maker = level.orders[0]
+            if accept is not None and not accept(maker):
+                self.remove(maker.id)
+                result.dropped.append(maker)
+                continue
+            trade_amount = min(order.amount, maker.amount)
+            price = order.price if order.side == "buy" else level.price
+            maker.amount -= trade_amount
+            level.quantity -= trade_amount
+            order.amount -= trade_amount
+            if maker.amount == 0:
+                level.orders.popleft()
+                del self._orders[maker.id]
+                if not level.orders:
+                    opposite._drop_level(level)
+            result.fills.append(
+                Fill(
+                    taker_id=order.id,
+                    maker_id=maker.id,
+                    taker_user_id=order.user_id,
+                    maker_user_id=maker.user_id,
+                    side=order.side,
+                    price=price,
+                    amount=trade_amount,
+                    maker_remaining=maker.amount,
+                    maker_price=level.price,
+                )
+            )
+        if order.amount > 0:
+            self.add(order)
+        return result
+
+
+class MatchingEngine:
+    """Holds one :class:`InstrumentBook` per trading pair in worker memory.
+
+    Redis remains the published copy of the book: the engine is rebuilt from
+    the ``<instrument>/bid``/``<instrument>/ask`` sorted sets and the order
+    hashes at startup and the worker writes the outcome of every match back
+    in a single pipeline.
+    """
+
+    publishes_fills = False
+
+    def __init__(self, instruments: Iterable[str] = ()) -> None:
+        self.books: Dict[str, InstrumentBook] = {}
+        self._index: Dict[str, str] = {}
+        for instrument in instruments:
+            self.book(instrument)
+
+    def book(self, instrument: str) -> InstrumentBook:
+        book = self.books.get(instrument)
+        if book is None:
+            book = InstrumentBook(instrument)
+            self.books[instrument] = book
+        return book
+
+    def find(self, order_id: str) -> Optional[RestingOrder]:
+        instrument = self._index.get(order_id)
+        if instrument is None:
+            return None
+        return self.books[instrument].get(order_id)
+
+    def add(self, order: RestingOrder) -> None:
+        self.book(order.instrument).add(order)
+        self._index[order.id] = order.instrument
+
+    def remove(self, order_id: str) -> Optional[RestingOrder]:
+        instrument = self._index.pop(order_id, None)
+        if instrument is None:
+            return None
+        return self.books[instrument].remove(order_id)
+
+    def match(
+        self,
+        order: RestingOrder,
+        accept: Callable[[RestingOrder], bool] | None = None,
+    ) -> MatchResult:
+        self._index.pop(order.id, None)
+        result = self.book(order.instrument).match(order, accept)
+        for fill in result.fills:
+            if fill.maker_remaining == 0:
+                self._index.pop(fill.maker_id, None)
+        for dropped in result.dropped:
+            self._index.pop(dropped.id, None)
+        if result.remaining > 0:
+            self._index[order.id] = order.instrument
+        return result
+
+    def load(self, redis, settings: Settings, instruments: Iterable[str]) -> int:
+        """Rebuild the books for ``instruments`` from Redis.
+
+        Orders are queued in the order they were placed (``created`` field)
+        so FIFO priority within a price level survives a worker restart.
+        Orders still stored with decimal prices are rewritten with integer
+        ticks.  Returns the number of orders loaded.
+        """
+        loaded = 0
+        upgrade = redis.pipeline()
+        for instrument in instruments:
+            self.books[instrument] = InstrumentBook(instrument)
+            order_ids: List[str] = []
+            for side_key in (f"{instrument}/bid", f"{instrument}/ask"):
+                order_ids.extend(redis.zrange(side_key, 0, -1))
+            if not order_ids:
+                continue
+            pipe = redis.pipeline(transaction=False)
+            for order_id in order_ids:
+                pipe.hgetall(order_id)
+            payloads = pipe.execute()
+            orders = []
+            for order_id, payload in zip(order_ids, payloads):
+                if not payload or payload.get("ordertype") not in {"buy", "sell"}:
+                    continue
+                order = order_from_payload(order_id, payload, settings)
+                if not payload.get("ticks"):
+                    side_key = f"{instrument}/bid" if order.side == "buy" else f"{instrument}/ask"
+                    upgrade.hset(order_id, mapping={"price": order.price, "ticks": 1})
+                    upgrade.zadd(side_key, {order_id: order.price})
+                orders.append((int(payload.get("created", 0)), order))
+            orders.sort(key=lambda item: (item[0], item[1].id))
+            for _, order in orders:
+                self.add(order)
+                loaded += 1
+        if len(upgrade):
+            upgrade.execute()
+        return loaded
+
+
+MATCH_STEP_SCRIPT = """
+-- One match iteration against the Redis book.
+-- KEYS[1]: opposite side sorted set
+-- ARGV: taker side, limit price in ticks, amount remaining
+local best
+if ARGV[1] == 'buy' then
+  best = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+else
+  best = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+end
+if #best == 0 then
+  return false
+end
+local match_id = best[1]
+local best_price = tonumber(best[2])
+local limit = tonumber(ARGV[2])
+if (ARGV[1] == 'buy' and best_price > limit) or (ARGV[1] == 'sell' and best_price < limit) then
+  return false
+end
+local maker = redis.call('HMGET', match_id, 'amount', 'uid')
+if not maker[1] then
+  redis.call('ZREM', KEYS[1], match_id)
+  return {match_id, '0', '0', 0, 0, 0}
+end
+local maker_amount = tonumber(maker[1])
+local trade_amount = math.min(tonumber(ARGV[3]), maker_amount)
+local price = limit
+if ARGV[1] == 'sell' then
+  price = best_price
+end
+local left = maker_amount - trade_amount
+if left == 0 then
+  redis.call('DEL', match_id)
+  redis.call('ZREM', KEYS[1], match_id)
+  redis.call('SREM', maker[2] .. '/orders', match_id)
+else
+  redis.call('HSET', match_id, 'amount', string.format('%d', left))
+end
+return {match_id, maker[2], price, trade_amount, left, best_price}
+"""
+
+
+class ScriptedMatcher:
+    """Matches directly against the Redis book with one ``EVALSHA`` per fill.
+
+    Each iteration picks the best opposite order and applies the fill to that
+    maker atomically.  The taker's remainder is published by the worker with
+    the rest of the batch.  Makers cannot be vetted before they are filled,
+    which is why ``accept`` is ignored here.
+
+    The makers' fills are therefore in Redis before the taker, the queue
+    acknowledgement and the settlement journal.  A crash in between loses the
+    makers' credit for those fills, and a reclaimed stream entry would match the
+    taker again, so the worker refuses this engine with stream ingestion.
+    """
+
+    publishes_fills = True
+
+    def __init__(self, redis: Redis, settings: Settings) -> None:
+        self.redis = redis
+        self.settings = settings
+        self._script = redis.register_script(MATCH_STEP_SCRIPT)
+
+    def find(self, order_id: str) -> Optional[RestingOrder]:
+        """Nothing is held in memory; the order's Redis payload is current."""
+        return None
+
+    def remove(self, order_id: str) -> Optional[RestingOrder]:
+        payload = self.redis.hgetall(order_id)
+        if not payload or payload.get("ordertype") not in {"buy", "sell"}:
+            return None
+        return order_from_payload(order_id, payload, self.settings)
+
+    def match(
+        self,
+        order: RestingOrder,
+        accept: Callable[[RestingOrder], bool] | None = None,
+    ) -> MatchResult:
+        instrument = order.instrument
+        opposite_key = f"{instrument}/ask" if order.side == "buy" else f"{instrument}/bid"
+        result = MatchResult(order=order)
+        while order.amount > 0:
+            step = self._script(
+                keys=[opposite_key],
+                args=[order.side, order.price, order.amount],
+            )
+            if not step:
+                break
+            match_id, maker_uid, price, trade_amount, left, maker_price = step
+            if not trade_amount:
+                continue
+            order.amount -= int(trade_amount)
+            result.fills.append(
+                Fill(
+                    taker_id=order.id,
+                    maker_id=match_id,
+                    taker_user_id=order.user_id,
+                    maker_user_id=int(maker_uid),
+                    side=order.side,
+                    price=int(price),
+                    amount=int(trade_amount),
+                    maker_remaining=int(left),
+                    maker_price=int(maker_price),
+                )
+            )
+        return result
+
+
+Matcher = Union[MatchingEngine, ScriptedMatcher]
+
+
+def order_from_payload(order_id: str, payload: Dict[str, str], settings: Settings) -> RestingOrder:
+    """Build a :class:`RestingOrder` from an order hash stored in Redis.
+
+    Only hashes flagged with ``ticks`` hold an integer price; older ones hold
+    a decimal string, which may itself look like an integer (``"1"``).
+    """
+    instrument = payload["instrument"]
+    spec = settings.instrument(instrument)
+    price = int(payload["price"]) if payload.get("ticks") else spec.to_ticks(Decimal(payload["price"]))
+    return RestingOrder(
+        id=order_id,
+        instrument=instrument,
+        side=payload["ordertype"],
+        price=price,
+        amount=int(payload.get("amount", 0)),
+        user_id=int(payload.get("uid", 0)),
+    )
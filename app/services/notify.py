@@ -0,0 +1,38 @@
+"""Wallet notifications handed from walletnotify/blocknotify hooks to the depositor."""
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import List
+
+from redis import Redis
+
+NOTIFY_KEY = "deposit_notify"
+
+
+@dataclass(slots=True)
+class Notification:
+    """A wallet transaction (``txid``) or, when ``txid`` is None, a new block for ``currency``."""
+
+    currency: str
+    txid: str | None = None
+
+    def encode(self) -> str:
+        return f"{self.currency}:{self.txid or ''}"
+
+    @classmethod
+    def decode(cls, value: str) -> "Notification":
+        currency, _, txid = value.partition(":")
+        return cls(currency, txid or None)
+
+
+def push_notification(redis: Redis, notification: Notification) -> None:
+    redis.rpush(NOTIFY_KEY, notification.encode())
+
+
+def fetch_notifications(redis: Redis, timeout: int, limit: int = 500) -> List[Notification]:
+    """Block up to ``timeout`` seconds for a notification, then take up to ``limit`` that are waiting."""
+    item = redis.blpop([NOTIFY_KEY], timeout=timeout)
+    if not item:
+        return []
+    values = [item[1], *(redis.lpop(NOTIFY_KEY, limit - 1) or [])]
+    return [Notification.decode(value) for value in values]
@@ -2,6 +2,7 @@
 from __future__ import annotations
 
 import logging
+import time
 from dataclasses import dataclass
 from decimal import Decimal
 from typing import Dict, Iterable, List
@@ -10,6 +11,10 @@ from redis import Redis
 from redis.exceptions import RedisError
 
 from ..settings import Settings
+from .depth import book_side, read_depth
+from .events import publish_update
+from .market import TickerStats, read_ticker, read_trades
+from .queues import order_queue
 
 
 @dataclass(slots=True)
@@ -36,6 +41,7 @@ class OrderBook:
     def __init__(self, redis_client: Redis, settings: Settings) -> None:
         self.redis = redis_client
         self.settings = settings
+        self.queue = order_queue(redis_client, settings)
         self.logger = logging.getLogger(self.__class__.__name__)
 
     @staticmethod
@@ -46,42 +52,44 @@ class OrderBook:
     def _ask_key(instrument: str) -> str:
         return f"{instrument}/ask"
 
-    @staticmethod
-    def _completed_key(instrument: str) -> str:
-        return f"{instrument}/completed"
-
-    def _instrument_multiplier(self, instrument: str) -> int:
-        base_currency = instrument.split("_")[0]
-        return self.settings.currency(base_currency).multiplier
-
     def place_order(self, order: Order) -> None:
         key = self._bid_key(order.instrument) if order.side == "buy" else self._ask_key(order.instrument)
+        price_ticks = self.settings.instrument(order.instrument).to_ticks(order.price)
         self.redis.hset(order.id, mapping={
             "instrument": order.instrument,
             "ordertype": order.side,
             "amount": order.amount,
             "uid": order.user_id,
-            "price": str(order.price),
+            "price": price_ticks,
+            "ticks": 1,
+            "created": time.time_ns(),
         })
         self.redis.sadd(f"{order.user_id}/orders", order.id)
-        self.redis.rpush("order_queue", order.id)
-        self.redis.zadd(key, {order.id: float(order.price)})
+        self.redis.zadd(key, {order.id: price_ticks})
+        publish_update(self.redis, order.instrument, [(book_side(order.side), price_ticks, order.amount)])
+        # Enqueue last so the worker never sees an order before it is booked.
+        self.queue.push(order.instrument, order.id)
 
     def cancel_order(self, order_id: str, user_id: int) -> bool:
         if not self.redis.sismember(f"{user_id}/orders", order_id):
             return False
+        instrument = self.redis.hget(order_id, "instrument")
+        if not instrument:
+            return False
         cancel_id = f"cancel:{order_id}"
         self.redis.hset(cancel_id, mapping={
+            "instrument": instrument,
             "ordertype": "cancel",
             "uid": user_id,
             "old_order_id": order_id,
         })
-        self.redis.rpush("order_queue", cancel_id)
+        self.queue.push(instrument, cancel_id)
         return True
 
     def list_orders(self, instrument: str, side: str) -> List[Dict[str, str]]:
         key = self._bid_key(instrument) if side == "bid" else self._ask_key(instrument)
-        multiplier = self._instrument_multiplier(instrument)
+        spec = self.settings.instrument(instrument)
+        multiplier = spec.base_multiplier
         orders: List[Dict[str, str]] = []
         try:
             for order_id, price in self.redis.zrange(key, 0, -1, withscores=True):
@@ -92,7 +100,7 @@ class OrderBook:
                 amount = int(payload.get("amount", 0))
                 orders.append(
                     {
-                        "price": price,
+                        "price": spec.to_float(price),
                         "amount": float(amount) / multiplier,
                     }
                 )
@@ -100,45 +108,64 @@ class OrderBook:
             self.logger.warning("Redis unavailable while listing orders: %s", exc)
         return orders
 
-    def get_volume(self, instrument: str) -> Dict[str, float]:
-        multiplier = self._instrument_multiplier(instrument)
-        completed_key = self._completed_key(instrument)
-        base_volume = 0.0
-        quote_volume = 0.0
+    def get_depth(self, instrument: str, levels: int) -> Dict[str, List[Dict[str, float]]]:
+        """Return the best ``levels`` aggregated bid and ask price levels."""
+        spec = self.settings.instrument(instrument)
         try:
-            for entry_id, price in self.redis.zrange(completed_key, 0, -1, withscores=True):
-                payload = self.redis.hgetall(entry_id)
-                if not payload:
-                    self.redis.zrem(completed_key, entry_id)
-                    continue
-                quote_volume += float(payload.get("quote_currency_amount", 0))
-                base_volume += float(payload.get("base_currency_amount", 0))
+            depth = read_depth(self.redis, instrument, levels)
         except RedisError as exc:
-            self.logger.warning("Redis unavailable while computing volume: %s", exc)
+            self.logger.warning("Redis unavailable while fetching depth: %s", exc)
+            depth = {"bid": [], "ask": []}
         return {
-            "base_currency_volume": round(base_volume, 8),
-            "quote_currency_volume": round(quote_volume, 8),
-            "multiplier": multiplier,
+            side: [{"price": spec.to_float(price), "amount": quantity / spec.base_multiplier} for price, quantity in entries]
+            for side, entries in depth.items()
         }
 
-    def get_high(self, instrument: str) -> float:
-        completed_key = self._completed_key(instrument)
+    def get_trades(self, instrument: str, limit: int, before: str | None = None) -> Dict[str, object]:
+        """Return the latest ``limit`` trades before the ``before`` cursor and the cursor to page on."""
+        spec = self.settings.instrument(instrument)
         try:
-            prices = self.redis.zrange(completed_key, -1, -1, withscores=True)
+            trades = read_trades(self.redis, instrument, limit, before)
         except RedisError as exc:
-            self.logger.warning("Redis unavailable while fetching high price: %s", exc)
-            return 0.0
-        if not prices:
-            return 0.0
-        return float(prices[0][1])
+            self.logger.warning("Redis unavailable while fetching trades: %s", exc)
+            trades = []
+        return {
+            "trades": [
+                {
+                    "id": trade.id,
+                    "time": trade.time,
+                    "side": trade.side,
+                    "price": spec.to_float(trade.price),
+                    "amount": trade.amount / spec.base_multiplier,
+                }
+                for trade in trades
+            ],
+            "next": trades[-1].id if len(trades) == limit else None,
+        }
 
-    def get_low(self, instrument: str) -> float:
-        completed_key = self._completed_key(instrument)
+    def get_ticker(self, instrument: str) -> Dict[str, object]:
+        """Return the rolling 24h volume, high and low in one read."""
+        spec = self.settings.instrument(instrument)
         try:
-            prices = self.redis.zrange(completed_key, 0, 0, withscores=True)
+            stats = read_ticker(self.redis, instrument)
         except RedisError as exc:
-            self.logger.warning("Redis unavailable while fetching low price: %s", exc)
-            return 0.0
-        if not prices:
-            return 0.0
-        return float(prices[0][1])
+            self.logger.warning("Redis unavailable while fetching ticker: %s", exc)
+            stats = TickerStats()
+        return {
+            "volume": {
+                "base_currency_volume": round(stats.base / spec.base_multiplier, 8),
+                "quote_currency_volume": round(stats.quote / spec.quote_multiplier, 8),
+                "multiplier": spec.base_multiplier,
+            },
+            "high": spec.to_float(stats.high),
+            "low": spec.to_float(stats.low),
+        }
+
+    def get_volume(self, instrument: str) -> Dict[str, float]:
+        return self.get_ticker(instrument)["volume"]
+
+    def get_high(self, instrument: str) -> float:
+        return self.get_ticker(instrument)["high"]
+
+    def get_low(self, instrument: str) -> float:
+        return self.get_ticker(instrument)["low"]
@@ -0,0 +1,212 @@
+"""Order ingestion queues shared by the web tier and the matching worker."""
+from __future__ import annotations
+
+import os
+import socket
+import time
+from dataclasses import dataclass
+from typing import Iterable, List, Union
+
+from redis import Redis
+from redis.exceptions import ResponseError
+
+from ..settings import Settings
+
+# Shared list every instrument was queued on before per-instrument queues.
+LEGACY_QUEUE = "order_queue"
+
+
+@dataclass(slots=True)
+class QueueItem:
+    order_id: str
+    source: str
+    entry_id: str | None = None
+
+
+class ListOrderQueue:
+    """Per-instrument Redis lists drained with ``BLPOP``.
+
+    Items are removed as soon as they are popped, so an order being matched
+    when the worker dies is lost.
+    """
+
+    idle_sleep = True
+
+    def __init__(self, redis: Redis, instruments: Iterable[str] = ()) -> None:
+        self.redis = redis
+        self.keys = [self.key(instrument) for instrument in instruments]
+
+    @staticmethod
+    def key(instrument: str) -> str:
+        return f"order_queue:{instrument}"
+
+    def push(self, instrument: str, order_id: str) -> None:
+        self.redis.rpush(self.key(instrument), order_id)
+
+    def reclaim(self) -> List[QueueItem]:
+        return []
+
+    def fetch(self, batch_size: int, max_latency_ms: int = 0) -> List[QueueItem]:
+        """Pop up to ``batch_size`` items, blocking only for the first one.
+
+        Once an item has arrived the batch keeps filling for at most
+        ``max_latency_ms`` before it is returned.
+        """
+        item = self.redis.blpop(self.keys, timeout=1)
+        if not item:
+            return []
+        items = [QueueItem(order_id=item[1], source=item[0])]
+        deadline = time.monotonic() + max_latency_ms / 1000
+        while len(items) < batch_size:
+            for key in self.keys:
+                popped = self.redis.lpop(key, batch_size - len(items))
+                if popped:
+                    items.extend(QueueItem(order_id=order_id, source=key) for order_id in popped)
+                if len(items) >= batch_size:
+                    break
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                time.sleep(min(remaining, 0.005))
+        return items
+
+    def ack(self, pipe, items: Iterable[QueueItem]) -> None:
+        """Items are already gone from the list once popped."""
+
+
+class StreamOrderQueue:
+    """Per-instrument Redis Streams read through a consumer group.
+
+    Entries stay pending until the worker acknowledges them in the same
+    Redis transaction that publishes the batch, so a crashed worker's
+    entries are reclaimed and matched again on restart.
+    """
+
+    group = "matchers"
+    idle_sleep = False
+    claim_count = 100
+
+    def __init__(self, redis: Redis, instruments: Iterable[str] = (), consumer: str | None = None) -> None:
+        self.redis = redis
+        self.keys = [self.key(instrument) for instrument in instruments]
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self._groups_ready = False
+
+    @staticmethod
+    def key(instrument: str) -> str:
+        return f"order_stream:{instrument}"
+
+    def push(self, instrument: str, order_id: str) -> None:
+        self.redis.xadd(self.key(instrument), {"order_id": order_id})
+
+    def _ensure_groups(self) -> None:
+        if self._groups_ready:
+            return
+        for key in self.keys:
+            try:
+                self.redis.xgroup_create(key, self.group, id="0", mkstream=True)
+            except ResponseError as exc:
+                if "BUSYGROUP" not in str(exc):
+                    raise
+        self._groups_ready = True
+
+    def reclaim(self) -> List[QueueItem]:
+        """Claim every entry left pending by previous consumers."""
+        self._ensure_groups()
+        items: List[QueueItem] = []
+        for key in self.keys:
+            start = "0-0"
+            while True:
+                response = self.redis.xautoclaim(
+                    key, self.group, self.consumer, min_idle_time=0, start_id=start, count=self.claim_count
+                )
+                start, claimed = response[0], response[1]
+                items.extend(
+                    QueueItem(order_id=fields["order_id"], source=key, entry_id=entry_id)
+                    for entry_id, fields in claimed
+                    if fields
+                )
+                if start == "0-0" or len(claimed) < self.claim_count:
+                    break
+        items.sort(key=lambda item: tuple(int(part) for part in item.entry_id.split("-")))
+        return items
+
+    def _read(self, count: int, block: int | None) -> List[QueueItem]:
+        response = self.redis.xreadgroup(
+            self.group,
+            self.consumer,
+            {key: ">" for key in self.keys},
+            count=count,
+            block=block,
+        )
+        items: List[QueueItem] = []
+        for key, entries in response or []:
+            items.extend(QueueItem(order_id=fields["order_id"], source=key, entry_id=entry_id) for entry_id, fields in entries)
+        return items
+
+    def fetch(self, batch_size: int, max_latency_ms: int = 0) -> List[QueueItem]:
+        self._ensure_groups()
+        # Only block when nothing is waiting; under load the first read
+        # already returns a full batch.
+        items = self._read(batch_size, block=None) or self._read(batch_size, block=1000)
+        if not items:
+            return []
+        deadline = time.monotonic() + max_latency_ms / 1000
+        while len(items) < batch_size:
+            more = self._read(batch_size - len(items), block=None)
+            if more:
+                items.extend(more)
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, 0.005))
+        return items
+
+    def ack(self, pipe, items: Iterable[QueueItem]) -> None:
+        for item in items:
+            pipe.xack(item.source, self.group, item.entry_id)
+            pipe.xdel(item.source, item.entry_id)
+
+
+OrderQueue = Union[ListOrderQueue, StreamOrderQueue]
+
+
+def order_queue(redis: Redis, settings: Settings, instruments: Iterable[str] = ()) -> OrderQueue:
+    """Return the ingestion queue configured through ``ORDER_INGEST``."""
+    if settings.order_ingest == "stream":
+        return StreamOrderQueue(redis, instruments)
+    return ListOrderQueue(redis, instruments)
+
+
+def migrate_legacy_queue(redis: Redis, settings: Settings) -> int:
+    """Move items left on the shared ``order_queue`` list onto their instrument's queue.
+
+    Items are moved in one transaction that is retried if another worker
+    migrates at the same time.  Cancels queued by the old web tier only name
+    the order they cancel, so they follow that order's instrument; items
+    whose order no longer exists are dropped.  Returns the number moved.
+    """
+
+    def move(pipe) -> int:
+        order_ids = pipe.lrange(LEGACY_QUEUE, 0, -1)
+        if not order_ids:
+            return 0
+        instruments = [pipe.hget(order_id, "instrument") for order_id in order_ids]
+        for index, order_id in enumerate(order_ids):
+            old_order_id = None if instruments[index] else pipe.hget(order_id, "old_order_id")
+            if old_order_id:
+                instruments[index] = pipe.hget(old_order_id, "instrument")
+        pipe.multi()
+        # ``push`` only writes, so the queue can buffer its commands on the transaction.
+        queue = order_queue(pipe, settings)
+        moved = 0
+        for order_id, instrument in zip(order_ids, instruments):
+            if instrument in settings.trading_pairs:
+                queue.push(instrument, order_id)
+                moved += 1
+        pipe.ltrim(LEGACY_QUEUE, len(order_ids), -1)
+        return moved
+
+    return redis.transaction(move, LEGACY_QUEUE, value_from_callable=True)
@@ -2,6 +2,7 @@
 from __future__ import annotations
 
 from dataclasses import dataclass, field
+from decimal import ROUND_HALF_EVEN, Decimal
 from typing import Dict, List
 import os
 
@@ -32,6 +33,43 @@ class CurrencySettings:
     rpc_url: str
     multiplier: int = 100_000_000
     min_confirmations: int = 1
+    min_withdrawal: int = 100_000
+
+
+@dataclass(slots=True)
+class InstrumentSettings:
+    """Precomputed multipliers for a trading pair.
+
+    Prices are held as integer ticks: the price of one whole base coin in the
+    quote currency's smallest unit, so order book comparisons and settlement
+    never construct a ``Decimal``.
+    """
+
+    code: str
+    base_currency: str
+    quote_currency: str
+    base_multiplier: int
+    quote_multiplier: int
+
+    def to_ticks(self, price: Decimal) -> int:
+        return int((price * self.quote_multiplier).quantize(Decimal(1), rounding=ROUND_HALF_EVEN))
+
+    def to_price(self, ticks: int) -> Decimal:
+        return Decimal(ticks) / self.quote_multiplier
+
+    def to_float(self, ticks: float) -> float:
+        return ticks / self.quote_multiplier
+
+    def quote_units(self, amount_units: int, price_ticks: int) -> int:
+        """Return ``amount_units`` of base currency priced at ``price_ticks``.
+
+        The result is rounded half to even, matching ``Decimal.quantize``.
+        """
+        units, remainder = divmod(amount_units * price_ticks, self.base_multiplier)
+        twice = remainder * 2
+        if twice > self.base_multiplier or (twice == self.base_multiplier and units % 2):
+            units += 1
+        return units
 
 
 @dataclass(slots=True)
@@ -44,7 +82,23 @@ class Settings:
     rpc_timeout: int
     currencies: Dict[str, CurrencySettings] = field(default_factory=dict)
     trading_pairs: List[str] = field(default_factory=list)
+    order_ingest: str = "list"
     mail: MailSettings = field(default_factory=MailSettings)
+    instruments: Dict[str, InstrumentSettings] = field(default_factory=dict)
+
+    def __post_init__(self) -> None:
+        for pair in self.trading_pairs:
+            if pair in self.instruments:
+                continue
+            base_currency, quote_currency = pair.split("_")
+            if base_currency in self.currencies and quote_currency in self.currencies:
+                self.instruments[pair] = InstrumentSettings(
+                    code=pair,
+                    base_currency=base_currency,
+                    quote_currency=quote_currency,
+                    base_multiplier=self.currencies[base_currency].multiplier,
+                    quote_multiplier=self.currencies[quote_currency].multiplier,
+                )
 
     def currency(self, code: str) -> CurrencySettings:
         try:
@@ -52,6 +106,12 @@ class Settings:
         except KeyError as exc:  # pragma: no cover - defensive programming
             raise KeyError(f"Unknown currency '{code}'") from exc
 
+    def instrument(self, code: str) -> InstrumentSettings:
+        try:
+            return self.instruments[code]
+        except KeyError as exc:
+            raise KeyError(f"Unknown trading pair '{code}'") from exc
+
 
 _DEFAULT_RPC_ENDPOINTS: Dict[str, tuple[str, int]] = {
     "btc": ("Bitcoin", 8332),
@@ -77,6 +137,8 @@ def _build_currency_settings(timeout: int) -> Dict[str, CurrencySettings]:
             rpc_url=url,
             multiplier=100_000_000,
             min_confirmations=max(int(os.getenv(f"RPC_{code.upper()}_CONFIRMATIONS", "1")), 1),
+            # Smallest units; far above the dust limit wallets refuse to pay.
+            min_withdrawal=max(int(os.getenv(f"RPC_{code.upper()}_MIN_WITHDRAWAL", "100000")), 1),
         )
     return currencies
 
@@ -106,6 +168,9 @@ def get_settings() -> Settings:
         "ltc_btc,bch_btc,dash_btc,doge_btc",
     )
     trading_pairs = [pair.strip().lower() for pair in trading_pairs_env.split(",") if pair.strip()]
+    order_ingest = os.getenv("ORDER_INGEST", "list").strip().lower()
+    if order_ingest not in {"list", "stream"}:
+        raise ValueError(f"ORDER_INGEST must be 'list' or 'stream', not '{order_ingest}'")
     mail_settings = _load_mail_settings()
     return Settings(
         secret_key=secret_key,
@@ -114,5 +179,6 @@ def get_settings() -> Settings:
         rpc_timeout=rpc_timeout,
         currencies=currencies,
         trading_pairs=trading_pairs,
+        order_ingest=order_ingest,
         mail=mail_settings,
     )
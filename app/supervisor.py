@@ -0,0 +1,185 @@
+"""Supervisor that runs one matching worker process per instrument group."""
+from __future__ import annotations
+
+import logging
+import signal
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+from typing import List
+
+import click
+
+from .logging_config import configure_logging
+from .settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class _Child:
+    instruments: List[str]
+    process: subprocess.Popen | None = None
+    restarts: int = 0
+    started_at: float = 0.0
+    restart_at: float = 0.0
+
+
+def _plan_groups(groups: tuple[str, ...], trading_pairs: List[str]) -> List[List[str]]:
+    """Split trading pairs into worker groups.
+
+    Every configured pair that is not named in an explicit ``--group`` gets a
+    worker of its own.
+    """
+    planned: List[List[str]] = []
+    assigned: set[str] = set()
+    for group in groups:
+        instruments = [pair.strip().lower() for pair in group.split(",") if pair.strip()]
+        unknown = set(instruments) - set(trading_pairs)
+        if unknown:
+            raise click.BadParameter(f"Unknown trading pairs: {', '.join(sorted(unknown))}", param_hint="--group")
+        duplicated = assigned.intersection(instruments)
+        if duplicated:
+            raise click.BadParameter(
+                f"Trading pairs assigned twice: {', '.join(sorted(duplicated))}", param_hint="--group"
+            )
+        assigned.update(instruments)
+        planned.append(instruments)
+    planned.extend([pair] for pair in trading_pairs if pair not in assigned)
+    return planned
+
+
+def _worker_command(instruments: List[str], options: List[str]) -> List[str]:
+    command = [sys.executable, "-m", "app.worker", *options]
+    for instrument in instruments:
+        command.extend(["--instrument", instrument])
+    return command
+
+
+def _start(child: _Child, options: List[str]) -> None:
+    child.process = subprocess.Popen(_worker_command(child.instruments, options))
+    child.started_at = time.monotonic()
+    logger.info("Started worker %s for %s", child.process.pid, ", ".join(child.instruments))
+
+
+def _stop(children: List[_Child], timeout: float) -> None:
+    for child in children:
+        if child.process and child.process.poll() is None:
+            child.process.terminate()
+    deadline = time.monotonic() + timeout
+    for child in children:
+        if not child.process:
+            continue
+        try:
+            child.process.wait(max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            child.process.kill()
+            child.process.wait()
+
+
+@click.command()
+@click.option(
+    "--group",
+    "groups",
+    multiple=True,
+    help="Comma separated trading pairs matched by one process (repeatable)",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(["memory", "lua"]),
+    default="memory",
+    show_default=True,
+    help="Matching engine passed to every worker",
+)
+@click.option("--batch-size", type=click.IntRange(min=1), default=1, show_default=True, help="Queue items per SQL transaction in every worker")
+@click.option(
+    "--max-latency-ms",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="How long every worker waits for a batch to fill",
+)
+@click.option(
+    "--flush-interval-ms",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="How long every worker caches balance changes before writing them to SQL",
+)
+@click.option("--restart-delay", type=float, default=1.0, show_default=True, help="Seconds to wait before restarting")
+@click.option("--max-restart-delay", type=float, default=60.0, show_default=True, help="Upper bound for restart backoff")
+def main(
+    groups: tuple[str, ...],
+    engine: str,
+    batch_size: int,
+    max_latency_ms: int,
+    flush_interval_ms: int,
+    restart_delay: float,
+    max_restart_delay: float,
+) -> None:
+    configure_logging()
+    settings = get_settings()
+    if engine == "lua" and batch_size > 1:
+        raise click.BadParameter("the lua engine matches one queue item at a time", param_hint="--batch-size")
+    if engine == "lua" and settings.order_ingest == "stream":
+        raise click.BadParameter(
+            "the lua engine fills makers before the queue entry is acknowledged, "
+            "so ORDER_INGEST=stream would match a reclaimed order twice",
+            param_hint="--engine",
+        )
+    options = [
+        "--engine",
+        engine,
+        "--batch-size",
+        str(batch_size),
+        "--max-latency-ms",
+        str(max_latency_ms),
+        "--flush-interval-ms",
+        str(flush_interval_ms),
+    ]
+    children = [_Child(instruments) for instruments in _plan_groups(groups, settings.trading_pairs)]
+    stopping = False
+
+    def _request_stop(signum, frame):  # pragma: no cover - signal handler
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, _request_stop)
+    signal.signal(signal.SIGINT, _request_stop)
+
+    for child in children:
+        _start(child, options)
+    try:
+        while not stopping:
+            now = time.monotonic()
+            for child in children:
+                if child.process is None:
+                    if now >= child.restart_at:
+                        _start(child, options)
+                    continue
+                returncode = child.process.poll()
+                if returncode is None:
+                    continue
+                # Back off exponentially for workers that crash repeatedly,
+                # and reset once a worker has stayed up for a while.
+                if now - child.started_at > max_restart_delay:
+                    child.restarts = 0
+                delay = min(restart_delay * 2**child.restarts, max_restart_delay)
+                logger.warning(
+                    "Worker for %s exited with %s; restarting in %.1fs",
+                    ", ".join(child.instruments),
+                    returncode,
+                    delay,
+                )
+                child.process = None
+                child.restarts += 1
+                child.restart_at = now + delay
+            time.sleep(0.5)
+    finally:
+        logger.info("Stopping %s matching workers", len(children))
+        _stop(children, timeout=10)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -0,0 +1,203 @@
+"""Worker that pays out queued withdrawals in batches with ``sendmany``."""
+from __future__ import annotations
+
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Dict, List
+
+import click
+from sqlalchemy import select
+
+from . import create_app
+from .database import db_session
+from .models import CompletedOrder, WithdrawalBatch
+from .rpc import WalletError, WalletRejected
+from .services import accounts
+
+logger = logging.getLogger(__name__)
+
+# RPC_WALLET_INSUFFICIENT_FUNDS: the payment can succeed once the wallet is topped up.
+INSUFFICIENT_FUNDS = -6
+
+
+def _unbatched(currency_code: str, limit: int) -> List[CompletedOrder]:
+    return list(
+        db_session.execute(
+            select(CompletedOrder)
+            .where(
+                CompletedOrder.is_withdrawal.is_(True),
+                CompletedOrder.base_currency == currency_code,
+                CompletedOrder.transaction_id.is_(None),
+                CompletedOrder.withdrawal_batch_id.is_(None),
+            )
+            .order_by(CompletedOrder.created_at, CompletedOrder.id)
+            .limit(limit)
+        ).scalars()
+    )
+
+
+def _refund(withdrawals: List[CompletedOrder]) -> None:
+    """Return the amount of withdrawals that can never be paid and mark them as refunded."""
+    changes = [accounts.BalanceChange(order.user_id, order.base_currency, order.amount) for order in withdrawals]
+    accounts.apply_balance_changes(changes, commit=False, create_missing=True)
+    for order in withdrawals:
+        logger.warning("Refunding withdrawal %s to %s, which the wallet refuses", order.id, order.withdrawal_address)
+        order.is_withdrawal = False
+        order.side = "REFUND"
+
+
+def _utc(value: datetime) -> datetime:
+    # SQLite hands back naive datetimes; they are stored in UTC.
+    return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+
+
+def _open_batch(registry, currency_code: str, window: float, max_outputs: int) -> WithdrawalBatch | None:
+    """Group the currency's queued withdrawals into a batch once the oldest has waited ``window`` seconds."""
+    withdrawals = _unbatched(currency_code, max_outputs)
+    if not withdrawals:
+        return None
+    if datetime.now(timezone.utc) - _utc(withdrawals[0].created_at) < timedelta(seconds=window):
+        return None
+    addresses = sorted({order.withdrawal_address for order in withdrawals})
+    try:
+        valid = registry.validate_addresses(currency_code, addresses)
+    except WalletError as exc:
+        logger.warning("Unable to validate %s withdrawal addresses: %s", currency_code, exc)
+        return None
+    invalid = [order for order in withdrawals if not valid.get(order.withdrawal_address)]
+    if invalid:
+        _refund(invalid)
+    payable = [order for order in withdrawals if valid.get(order.withdrawal_address)]
+    if not payable:
+        db_session.commit()
+        return None
+    batch = WithdrawalBatch(currency=currency_code, withdrawals=payable)
+    db_session.add(batch)
+    db_session.commit()
+    return batch
+
+
+def _amounts(batch: WithdrawalBatch, multiplier: int) -> Dict[str, Decimal]:
+    # sendmany takes every address once, so withdrawals to the same address are summed.
+    units: Dict[str, int] = {}
+    for order in batch.withdrawals:
+        units[order.withdrawal_address] = units.get(order.withdrawal_address, 0) + order.amount
+    return {address: Decimal(amount) / multiplier for address, amount in units.items()}
+
+
+def _record_payment(batch: WithdrawalBatch, txid: str) -> None:
+    batch.status = "sent"
+    batch.transaction_id = txid
+    for order in batch.withdrawals:
+        order.transaction_id = txid
+    db_session.commit()
+    logger.info("Paid %d %s withdrawals in %s", len(batch.withdrawals), batch.currency.upper(), txid)
+
+
+def _find_payment(registry, batch: WithdrawalBatch) -> str | None:
+    """Return the txid the wallet sent ``batch`` in, raising WalletError when that cannot be told."""
+    since = _utc(batch.created_at).timestamp()
+    txid = registry.find_sent_transaction(batch.currency, batch.comment, since)
+    if txid is None:
+        return None
+    transaction = registry.get_transactions(batch.currency, [txid]).get(txid)
+    if transaction is None or transaction.get("confirmations", 0) < 0:
+        # A conflicted or abandoned payment may still confirm, so it is left for an operator.
+        raise WalletError(f"payment {txid} is not a valid wallet transaction")
+    return txid
+
+
+def _reject(batch: WithdrawalBatch) -> None:
+    """Fail ``batch`` and give each of its addresses a batch of its own, or refund a lone address."""
+    batch.status = "failed"
+    withdrawals = list(batch.withdrawals)
+    addresses = sorted({order.withdrawal_address for order in withdrawals})
+    if len(addresses) == 1:
+        _refund(withdrawals)
+        return
+    for address in addresses:
+        db_session.add(
+            WithdrawalBatch(
+                currency=batch.currency,
+                withdrawals=[order for order in withdrawals if order.withdrawal_address == address],
+            )
+        )
+
+
+def _send_batch(registry, settings, batch: WithdrawalBatch) -> None:
+    """Pay ``batch`` unless the wallet already holds its payment.
+
+    The batch is marked ``sending`` before ``sendmany`` is submitted and the
+    txid is recorded as soon as it returns.  If the worker dies, or the
+    connection drops before the txid comes back, the next attempt first looks
+    the payment up by the batch's wallet comment and checks it with
+    ``gettransaction``, so a retry never pays twice.
+    """
+    if batch.status == "sending":
+        try:
+            txid = _find_payment(registry, batch)
+        except WalletError as exc:
+            logger.warning("Unable to look up %s withdrawal batch %s: %s", batch.currency, batch.id, exc)
+            return
+        if txid:
+            _record_payment(batch, txid)
+            return
+    batch.status = "sending"
+    db_session.commit()
+    multiplier = settings.currency(batch.currency).multiplier
+    try:
+        txid = registry.send_many(batch.currency, _amounts(batch, multiplier), batch.comment)
+    except WalletRejected as exc:
+        # The daemon refused the payment, so nothing was sent.
+        logger.warning("Wallet rejected %s withdrawal batch %s: %s", batch.currency, batch.id, exc)
+        if exc.code == INSUFFICIENT_FUNDS:
+            batch.status = "open"
+        else:
+            _reject(batch)
+        db_session.commit()
+        return
+    except WalletError as exc:
+        logger.warning("Outcome of %s withdrawal batch %s unknown, checking on retry: %s", batch.currency, batch.id, exc)
+        return
+    _record_payment(batch, txid)
+
+
+def _process_currency(registry, settings, currency_code: str, window: float, max_outputs: int) -> None:
+    unfinished = db_session.execute(
+        select(WithdrawalBatch)
+        .where(WithdrawalBatch.currency == currency_code, WithdrawalBatch.status.in_(("open", "sending")))
+        .order_by(WithdrawalBatch.id)
+    ).scalars().all()
+    for batch in unfinished:
+        _send_batch(registry, settings, batch)
+        if batch.status != "sent":
+            # Keep payments in order; later batches wait until this one is settled.
+            return
+    batch = _open_batch(registry, currency_code, window, max_outputs)
+    if batch is not None:
+        _send_batch(registry, settings, batch)
+
+
+@click.command()
+@click.option("--interval", type=int, default=30, help="Polling interval in seconds")
+@click.option("--window", type=float, default=300.0, help="Seconds the oldest queued withdrawal waits for others to join its batch")
+@click.option("--max-outputs", type=int, default=500, help="Most withdrawals paid by one transaction")
+@click.option("--once", is_flag=True, help="Process a single iteration and exit")
+def main(interval: int, window: float, max_outputs: int, once: bool) -> None:
+    app = create_app()
+    with app.app_context():
+        registry = app.extensions["wallet_registry"]
+        settings = app.extensions["settings"]
+        logger.info("Starting withdrawal processor")
+        while True:
+            for code in settings.currencies:
+                _process_currency(registry, settings, code, window, max_outputs)
+            if once:
+                break
+            time.sleep(interval)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
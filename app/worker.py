@@ -3,213 +3,340 @@ from __future__ import annotations
 
 import logging
 import time
-from decimal import Decimal
+from typing import List
 
 import click
 from . import create_app
-from .database import db_session, get_redis_client
-from .models import CompletedOrder, User
-from .services import accounts
+from .database import get_redis_client
+from .services.matching import (
+    Fill,
+    Matcher,
+    MatchingEngine,
+    MatchResult,
+    RestingOrder,
+    ScriptedMatcher,
+    order_from_payload,
+)
+from .services.depth import rebuild_depth
+from .services.events import publish_update
+from .services.ledger import SettlementLedger
+from .services.market import MarketFeed
+from .services.queues import OrderQueue, QueueItem, migrate_legacy_queue, order_queue
 from .settings import Settings
 
 logger = logging.getLogger(__name__)
 
 
-def _quote_units(settings: Settings, instrument: str, amount_units: int, price: Decimal) -> int:
-    base_currency, quote_currency = instrument.split("_")
-    base_multiplier = Decimal(settings.currency(base_currency).multiplier)
-    quote_multiplier = Decimal(settings.currency(quote_currency).multiplier)
-    return int((Decimal(amount_units) / base_multiplier * price * quote_multiplier).quantize(Decimal(1)))
+def _quote_units(settings: Settings, instrument: str, amount_units: int, price_ticks: int) -> int:
+    return settings.instrument(instrument).quote_units(amount_units, price_ticks)
 
 
-def _record_trade(user_id: int, instrument: str, side: str, amount_units: int, price: Decimal) -> None:
-    base_currency, quote_currency = instrument.split("_")
-    order = CompletedOrder(
-        user_id=user_id,
-        instrument=instrument,
-        side=side,
-        base_currency=base_currency,
-        quote_currency=quote_currency,
-        amount=amount_units,
-        price=price,
-    )
-    db_session.add(order)
-
-
-def _handle_cancel(settings: Settings, redis, order: dict) -> None:
+def _handle_cancel(
+    settings: Settings,
+    engine: Matcher,
+    ledger: SettlementLedger,
+    feed: MarketFeed,
+    pipe,
+    order: dict,
+) -> str | None:
+    """Cancel the order named by ``order`` and return its id if it was still resting."""
     old_order_id = order.get("old_order_id")
-    if not old_order_id or not redis.exists(old_order_id):
-        return
-    existing = redis.hgetall(old_order_id)
-    instrument = existing.get("instrument")
-    if not instrument:
-        redis.delete(old_order_id)
-        return
-    user_id = int(existing.get("uid", 0))
-    user = db_session.get(User, user_id)
-    if not user:
-        redis.delete(old_order_id)
-        return
-    side = existing.get("ordertype")
-    amount_units = int(existing.get("amount", 0))
-    price = Decimal(existing.get("price", "0"))
-    base_currency, quote_currency = instrument.split("_")
-    if side == "buy":
-        refund_units = _quote_units(settings, instrument, amount_units, price)
-        accounts.change_balance(user, quote_currency, refund_units)
-        redis.zrem(f"{instrument}/bid", old_order_id)
-    else:
-        accounts.change_balance(user, base_currency, amount_units)
-        redis.zrem(f"{instrument}/ask", old_order_id)
-    redis.delete(old_order_id)
-    redis.srem(f"{user_id}/orders", old_order_id)
-
-
-def _match_order(settings: Settings, redis, order_id: str, payload: dict) -> None:
-    instrument = payload["instrument"]
-    side = payload["ordertype"]
-    price = Decimal(payload["price"])
-    amount_remaining = int(payload["amount"])
-    user_id = int(payload["uid"])
-    user = db_session.get(User, user_id)
-    if not user:
-        logger.warning("Dropping order %s for unknown user %s", order_id, user_id)
-        return
-    base_currency, quote_currency = instrument.split("_")
-    bid_key = f"{instrument}/bid"
-    ask_key = f"{instrument}/ask"
-    completed_key = f"{instrument}/completed"
-
-    if side == "buy":
-        while amount_remaining > 0:
-            best_match = redis.zrange(ask_key, 0, 0)
-            if not best_match:
-                break
-            match_id = best_match[0]
-            best_price = Decimal(str(redis.zscore(ask_key, match_id)))
-            if best_price > price:
-                break
-            match_payload = redis.hgetall(match_id)
-            match_amount = int(match_payload.get("amount", 0))
-            seller_id = int(match_payload.get("uid", 0))
-            seller = db_session.get(User, seller_id)
-            if not seller:
-                redis.delete(match_id)
-                redis.zrem(ask_key, match_id)
-                continue
-            trade_amount = min(amount_remaining, match_amount)
-            quote_units = _quote_units(settings, instrument, trade_amount, price)
-            accounts.change_balance(seller, quote_currency, quote_units)
-            accounts.change_balance(user, base_currency, trade_amount)
-            _record_trade(user.id, instrument, "buy", trade_amount, price)
-            _record_trade(seller.id, instrument, "sell", trade_amount, price)
-            completed_id = f"completed:{order_id}:{match_id}:{trade_amount}"
-            redis.hset(
-                completed_id,
-                mapping={
-                    "price": float(price),
-                    "quote_currency_amount": float(quote_units) / settings.currency(quote_currency).multiplier,
-                    "base_currency_amount": float(trade_amount) / settings.currency(base_currency).multiplier,
-                },
-            )
-            redis.zadd(completed_key, {completed_id: float(price)})
-            amount_remaining -= trade_amount
-            if trade_amount == match_amount:
-                redis.delete(match_id)
-                redis.zrem(ask_key, match_id)
-                redis.srem(f"{seller_id}/orders", match_id)
-            else:
-                redis.hset(match_id, mapping={"amount": match_amount - trade_amount})
-            db_session.commit()
-        if amount_remaining > 0:
-            redis.hset(order_id, mapping={"amount": amount_remaining})
-            redis.zadd(bid_key, {order_id: float(price)})
+    if not old_order_id:
+        return None
+    resting = engine.remove(old_order_id)
+    if resting is None:
+        return None
+    side_key = f"{resting.instrument}/bid" if resting.side == "buy" else f"{resting.instrument}/ask"
+    feed.adjust_depth(resting.instrument, resting.side, resting.price, -resting.amount)
+    if ledger.user_exists(resting.user_id):
+        spec = settings.instrument(resting.instrument)
+        settlement = ledger.settlement(resting.instrument)
+        if resting.side == "buy":
+            refund_units = _quote_units(settings, resting.instrument, resting.amount, resting.price)
+            settlement.credit(resting.user_id, spec.quote_currency, refund_units)
         else:
-            redis.delete(order_id)
-            redis.zrem(bid_key, order_id)
-            redis.srem(f"{user_id}/orders", order_id)
-    elif side == "sell":
-        while amount_remaining > 0:
-            best_match = redis.zrange(bid_key, -1, -1)
-            if not best_match:
-                break
-            match_id = best_match[0]
-            best_price = Decimal(str(redis.zscore(bid_key, match_id)))
-            if best_price < price:
-                break
-            match_payload = redis.hgetall(match_id)
-            match_amount = int(match_payload.get("amount", 0))
-            buyer_id = int(match_payload.get("uid", 0))
-            buyer = db_session.get(User, buyer_id)
-            if not buyer:
-                redis.delete(match_id)
-                redis.zrem(bid_key, match_id)
-                continue
-            trade_amount = min(amount_remaining, match_amount)
-            quote_units = _quote_units(settings, instrument, trade_amount, best_price)
-            accounts.change_balance(buyer, base_currency, trade_amount)
-            accounts.change_balance(user, quote_currency, quote_units)
-            _record_trade(buyer.id, instrument, "buy", trade_amount, best_price)
-            _record_trade(user.id, instrument, "sell", trade_amount, best_price)
-            completed_id = f"completed:{order_id}:{match_id}:{trade_amount}"
-            redis.hset(
-                completed_id,
-                mapping={
-                    "price": float(best_price),
-                    "quote_currency_amount": float(quote_units) / settings.currency(quote_currency).multiplier,
-                    "base_currency_amount": float(trade_amount) / settings.currency(base_currency).multiplier,
-                },
-            )
-            redis.zadd(completed_key, {completed_id: float(best_price)})
-            amount_remaining -= trade_amount
-            if trade_amount == match_amount:
-                redis.delete(match_id)
-                redis.zrem(bid_key, match_id)
-                redis.srem(f"{buyer_id}/orders", match_id)
+            settlement.credit(resting.user_id, spec.base_currency, resting.amount)
+    pipe.zrem(side_key, old_order_id)
+    pipe.delete(old_order_id)
+    pipe.srem(f"{resting.user_id}/orders", old_order_id)
+    return old_order_id
+
+
+def _settle_fill(
+    settings: Settings, ledger: SettlementLedger, instrument: str, fill: Fill, maker_known: bool, executed_at: float
+) -> int:
+    spec = settings.instrument(instrument)
+    maker = fill.maker_user_id if maker_known else None
+    buyer, seller = (fill.taker_user_id, maker) if fill.side == "buy" else (maker, fill.taker_user_id)
+    quote_units = _quote_units(settings, instrument, fill.amount, fill.price)
+    settlement = ledger.settlement(instrument)
+    if seller is not None:
+        settlement.credit(seller, spec.quote_currency, quote_units)
+        settlement.record(seller, "sell", fill.amount, fill.price, executed_at)
+    if buyer is not None:
+        settlement.credit(buyer, spec.base_currency, fill.amount)
+        settlement.record(buyer, "buy", fill.amount, fill.price, executed_at)
+    return quote_units
+
+
+def _publish_match(pipe, result: MatchResult, include_fills: bool = True) -> None:
+    """Queue the outcome of a match on the batch's Redis pipeline.
+
+    ``include_fills`` is false when the matcher already applied the fills to
+    the Redis book itself, leaving only the incoming order to publish.
+    """
+    order = result.order
+    instrument = order.instrument
+    own_key, maker_key = (
+        (f"{instrument}/bid", f"{instrument}/ask") if order.side == "buy" else (f"{instrument}/ask", f"{instrument}/bid")
+    )
+
+    for dropped in result.dropped:
+        pipe.delete(dropped.id)
+        pipe.zrem(maker_key, dropped.id)
+    if include_fills:
+        for fill in result.fills:
+            if fill.maker_remaining == 0:
+                pipe.delete(fill.maker_id)
+                pipe.zrem(maker_key, fill.maker_id)
+                pipe.srem(f"{fill.maker_user_id}/orders", fill.maker_id)
             else:
-                redis.hset(match_id, mapping={"amount": match_amount - trade_amount})
-            db_session.commit()
-        if amount_remaining > 0:
-            redis.hset(order_id, mapping={"amount": amount_remaining})
-            redis.zadd(ask_key, {order_id: float(price)})
-        else:
-            redis.delete(order_id)
-            redis.zrem(ask_key, order_id)
-            redis.srem(f"{user_id}/orders", order_id)
+                pipe.hset(fill.maker_id, mapping={"amount": fill.maker_remaining})
+    if result.remaining > 0:
+        pipe.hset(order.id, mapping={"amount": result.remaining})
+        pipe.zadd(own_key, {order.id: order.price})
     else:
+        pipe.delete(order.id)
+        pipe.zrem(own_key, order.id)
+        pipe.srem(f"{order.user_id}/orders", order.id)
+
+
+def _match_order(
+    settings: Settings,
+    engine: Matcher,
+    ledger: SettlementLedger,
+    feed: MarketFeed,
+    pipe,
+    order_id: str,
+    payload: dict,
+) -> List[str]:
+    """Match one queued order and return the ids of resting orders it closed."""
+    side = payload.get("ordertype")
+    if side not in {"buy", "sell"}:
         logger.warning("Unknown order type %s", side)
+        return []
+    # An order loaded with the book at startup may already have been partly
+    # filled as a maker, so the engine's copy wins over the payload.
+    order = engine.find(order_id) or order_from_payload(order_id, payload, settings)
+    if not ledger.user_exists(order.user_id):
+        logger.warning("Dropping order %s for unknown user %s", order_id, order.user_id)
+        engine.remove(order_id)
+        feed.adjust_depth(order.instrument, order.side, order.price, -order.amount)
+        pipe.delete(order_id)
+        pipe.zrem(f"{order.instrument}/{'bid' if order.side == 'buy' else 'ask'}", order_id)
+        pipe.srem(f"{order.user_id}/orders", order_id)
+        return []
 
+    def accept(maker: RestingOrder) -> bool:
+        return ledger.user_exists(maker.user_id)
 
-def _process_once(settings: Settings, redis) -> bool:
-    item = redis.blpop("order_queue", timeout=1)
-    if not item:
-        return False
-    order_id = item[1]
-    payload = redis.hgetall(order_id)
-    if not payload:
-        return True
-    if payload.get("ordertype") == "cancel":
-        _handle_cancel(settings, redis, payload)
-    else:
-        _match_order(settings, redis, order_id, payload)
-    return True
+    result = engine.match(order, accept)
+    maker_side = "sell" if order.side == "buy" else "buy"
+    for fill in result.fills:
+        maker_known = ledger.user_exists(fill.maker_user_id)
+        if not maker_known:
+            logger.warning("Filled order %s belongs to unknown user %s", fill.maker_id, fill.maker_user_id)
+        executed_at = time.time()
+        quote_units = _settle_fill(settings, ledger, order.instrument, fill, maker_known, executed_at)
+        feed.record_fill(order.instrument, fill, quote_units, executed_at)
+        # The web tier added the whole taker to the depth index when it was placed.
+        feed.adjust_depth(order.instrument, order.side, order.price, -fill.amount)
+        feed.adjust_depth(order.instrument, maker_side, fill.maker_price, -fill.amount)
+    for dropped in result.dropped:
+        feed.adjust_depth(order.instrument, dropped.side, dropped.price, -dropped.amount)
+    _publish_match(pipe, result, include_fills=not engine.publishes_fills)
+    closed = [fill.maker_id for fill in result.fills if fill.maker_remaining == 0]
+    closed.extend(dropped.id for dropped in result.dropped)
+    return closed
+
+
+def _process_batch(
+    settings: Settings,
+    engine: Matcher,
+    ledger: SettlementLedger,
+    feed: MarketFeed,
+    redis,
+    queue: OrderQueue,
+    items: List[QueueItem],
+) -> None:
+    """Match ``items`` in queue order and publish them in one Redis transaction.
+
+    The book updates, the queue acknowledgements and the batch's settlement
+    journal entry are written atomically; balances and trades reach SQL when
+    the ledger next flushes.
+
+    Payloads are read once for the whole batch, before any of it is
+    published, so orders filled, dropped or cancelled by an earlier item are
+    skipped rather than matched again from their stale hash.  The Redis
+    script engine reads the live book instead of the batch's state, which
+    is why it only runs with batches of one.
+    """
+    fetch = redis.pipeline(transaction=False)
+    for item in items:
+        fetch.hgetall(item.order_id)
+    payloads = fetch.execute()
+    pipe = redis.pipeline()
+    closed: set[str] = set()
+    try:
+        for item, payload in zip(items, payloads):
+            if not payload or item.order_id in closed:
+                continue
+            if payload.get("ordertype") == "cancel":
+                cancelled = _handle_cancel(settings, engine, ledger, feed, pipe, payload)
+                if cancelled:
+                    closed.add(cancelled)
+            else:
+                closed.update(_match_order(settings, engine, ledger, feed, pipe, item.order_id, payload))
+        feed.publish(pipe)
+        queue.ack(pipe, items)
+        positions = ledger.journal(pipe)
+        results = pipe.execute()
+    except Exception:
+        ledger.discard_batch()
+        raise
+    ledger.commit_batch(positions, results)
+
+
+def _process_once(
+    settings: Settings,
+    engine: Matcher,
+    ledger: SettlementLedger,
+    feed: MarketFeed,
+    redis,
+    queue: OrderQueue,
+    batch_size: int = 1,
+    max_latency_ms: int = 0,
+) -> int:
+    items = queue.fetch(batch_size, max_latency_ms)
+    if items:
+        _process_batch(settings, engine, ledger, feed, redis, queue, items)
+    elif feed.pending():
+        # Roll the 24h window forward even when nothing trades.
+        pipe = redis.pipeline()
+        feed.publish(pipe)
+        pipe.execute()
+    ledger.flush()
+    return len(items)
+
+
+def _resume(
+    settings: Settings,
+    engine: Matcher,
+    ledger: SettlementLedger,
+    feed: MarketFeed,
+    redis,
+    queue: OrderQueue,
+    batch_size: int,
+) -> int:
+    """Re-process entries a previous worker fetched but never acknowledged."""
+    items = queue.reclaim()
+    for start in range(0, len(items), batch_size):
+        _process_batch(settings, engine, ledger, feed, redis, queue, items[start : start + batch_size])
+    ledger.flush(force=True)
+    return len(items)
 
 
 @click.command()
-@click.option("--once", is_flag=True, help="Process only one queue item and exit")
-@click.option("--sleep", "sleep_interval", type=int, default=1, help="Sleep between idle polling attempts")
-def main(once: bool, sleep_interval: int) -> None:
+@click.option("--once", is_flag=True, help="Process a single batch of queue items and exit")
+@click.option("--sleep", "sleep_interval", type=int, default=1, help="Sleep between idle polling attempts (list ingestion only)")
+@click.option(
+    "--engine",
+    "engine_name",
+    type=click.Choice(["memory", "lua"]),
+    default="memory",
+    show_default=True,
+    help="Match against the in-memory book or with an atomic Redis script per fill",
+)
+@click.option(
+    "--instrument",
+    "instruments",
+    multiple=True,
+    help="Only match the given trading pair (repeatable); defaults to all configured pairs",
+)
+@click.option("--batch-size", type=click.IntRange(min=1), default=1, show_default=True, help="Queue items per SQL transaction (memory engine only)")
+@click.option(
+    "--max-latency-ms",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="How long to wait for a batch to fill once the first item arrives",
+)
+@click.option(
+    "--flush-interval-ms",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="How long balance changes are cached before they are written to SQL; 0 writes every batch",
+)
+def main(
+    once: bool,
+    sleep_interval: int,
+    engine_name: str,
+    instruments: tuple[str, ...],
+    batch_size: int,
+    max_latency_ms: int,
+    flush_interval_ms: int,
+) -> None:
     app = create_app()
     with app.app_context():
         redis = get_redis_client()
         settings = app.extensions["settings"]
-        logger.info("Starting order matching worker")
-        while True:
-            processed = _process_once(settings, redis)
-            if once:
-                break
-            if not processed:
-                time.sleep(sleep_interval)
+        unknown = set(instruments) - set(settings.trading_pairs)
+        if unknown:
+            raise click.BadParameter(f"Unknown trading pairs: {', '.join(sorted(unknown))}", param_hint="--instrument")
+        if engine_name == "lua" and batch_size > 1:
+            raise click.BadParameter("the lua engine matches one queue item at a time", param_hint="--batch-size")
+        if engine_name == "lua" and settings.order_ingest == "stream":
+            raise click.BadParameter(
+                "the lua engine fills makers before the queue entry is acknowledged, "
+                "so ORDER_INGEST=stream would match a reclaimed order twice",
+                param_hint="--engine",
+            )
+        selected = list(instruments) or settings.trading_pairs
+        moved = migrate_legacy_queue(redis, settings)
+        if moved:
+            logger.info("Moved %s items from the legacy order_queue onto per-instrument queues", moved)
+        queue = order_queue(redis, settings, selected)
+        ledger = SettlementLedger(redis, settings, flush_interval_ms)
+        ledger.recover(selected)
+        feed = MarketFeed(selected)
+        feed.load(redis)
+        engine: Matcher
+        book = MatchingEngine()
+        loaded = book.load(redis, settings, selected)
+        rebuild_depth(redis, book, selected)
+        for instrument in selected:
+            # Subscribers holding levels from before the rebuild must resync.
+            publish_update(redis, instrument, reset=True)
+        if engine_name == "lua":
+            # The in-memory book is only used to upgrade decimal prices and rebuild depth.
+            engine = ScriptedMatcher(redis, settings)
+            logger.info("Starting order matching worker using Redis scripts")
+        else:
+            engine = book
+            logger.info("Starting order matching worker with %s resting orders", loaded)
+        try:
+            resumed = _resume(settings, engine, ledger, feed, redis, queue, batch_size)
+            if resumed:
+                logger.info("Resumed %s unacknowledged queue entries", resumed)
+            while True:
+                processed = _process_once(settings, engine, ledger, feed, redis, queue, batch_size, max_latency_ms)
+                if once:
+                    break
+                if not processed and queue.idle_sleep:
+                    time.sleep(sleep_interval)
+        finally:
+            ledger.flush(force=True)
 
 
 if __name__ == "__main__":  # pragma: no cover
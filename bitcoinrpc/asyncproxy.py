@@ -0,0 +1,174 @@
+"""
+  asyncio counterpart of AuthServiceProxy.
+
+  - keeps a small pool of HTTP/1.1 keep-alive connections per proxy
+  - sends Basic HTTP authentication headers
+  - parses all JSON numbers that look like floats as Decimal
+  - supports JSON-RPC batches and HTTP pipelining of several requests on one
+    connection
+"""
+
+import asyncio
+import base64
+import decimal
+import json
+import ssl
+import urllib.parse as urlparse
+
+from .authproxy import HTTP_TIMEOUT, USER_AGENT, EncodeDecimal, JSONRPCException, next_request_id
+
+
+class _Connection(object):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.reused = False
+
+    def send(self, request):
+        self.writer.write(request)
+
+    async def read_response(self):
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed by server")
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await self.reader.readline()
+                    break
+                body += await self.reader.readexactly(size)
+                await self.reader.readexactly(2)
+        else:
+            body = await self.reader.readexactly(int(headers.get("content-length", 0)))
+        keep_alive = headers.get("connection", "").lower() != "close"
+        return int(status_line.split()[1]), body, keep_alive
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncServiceProxy(object):
+    def __init__(self, service_url, timeout=HTTP_TIMEOUT, max_connections=4):
+        self.__url = urlparse.urlparse(service_url)
+        self.__port = self.__url.port or (443 if self.__url.scheme == "https" else 80)
+        authpair = ("%s:%s" % (self.__url.username, self.__url.password)).encode("utf8")
+        self.__auth_header = "Basic " + base64.b64encode(authpair).decode("ascii")
+        self.__path = self.__url.path or "/"
+        self.timeout = timeout
+        self.__idle = []
+        self.__slots = None
+        self.__max_connections = max_connections
+
+    async def call(self, method, *params, retry=True):
+        response = await self._request(self._payload(method, params), retry)
+        return self._result(response)
+
+    async def batch(self, rpc_call_list, retry=True):
+        """Send a JSON-RPC batch; returns the raw responses like ``AuthServiceProxy._batch``."""
+        return await self._request(list(rpc_call_list), retry)
+
+    async def pipeline(self, calls, retry=True):
+        """Send ``(method, params)`` calls back to back on one connection and return their results.
+
+        A call answered with an error yields its JSONRPCException in place of
+        a result.
+        """
+        bodies = [self._encode(self._payload(method, params)) for method, params in calls]
+        responses = await self._exchange(bodies, retry)
+        results = []
+        for response in responses:
+            try:
+                results.append(self._result(response))
+            except JSONRPCException as exc:
+                results.append(exc)
+        return results
+
+    async def close(self):
+        idle, self.__idle = self.__idle, []
+        for connection in idle:
+            connection.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _payload(self, method, params):
+        return {"version": "1.1", "method": method, "params": list(params), "id": next_request_id()}
+
+    def _encode(self, payload):
+        body = json.dumps(payload, default=EncodeDecimal).encode("utf8")
+        head = (
+            "POST %s HTTP/1.1\r\n"
+            "Host: %s\r\n"
+            "User-Agent: %s\r\n"
+            "Authorization: %s\r\n"
+            "Content-Type: application/json\r\n"
+            "Content-Length: %d\r\n\r\n"
+        ) % (self.__path, self.__url.hostname, USER_AGENT, self.__auth_header, len(body))
+        return head.encode("latin-1") + body
+
+    def _result(self, response):
+        if response.get("error") is not None:
+            raise JSONRPCException(response["error"])
+        if "result" not in response:
+            raise JSONRPCException({"code": -343, "message": "missing JSON-RPC result"})
+        return response["result"]
+
+    async def _request(self, payload, retry):
+        return (await self._exchange([self._encode(payload)], retry))[0]
+
+    async def _exchange(self, bodies, retry):
+        if self.__slots is None:
+            self.__slots = asyncio.Semaphore(self.__max_connections)
+        async with self.__slots:
+            connection = await self._checkout()
+            try:
+                return await asyncio.wait_for(self._roundtrip(connection, bodies), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # A reused keep-alive socket may have been closed by the daemon while idle.
+                if not (retry and connection.reused):
+                    raise
+                connection = await self._checkout(fresh=True)
+                return await asyncio.wait_for(self._roundtrip(connection, bodies), self.timeout)
+
+    async def _roundtrip(self, connection, bodies):
+        try:
+            for body in bodies:
+                connection.send(body)
+            await connection.writer.drain()
+            responses = []
+            keep_alive = True
+            for _ in bodies:
+                status, body, keep_alive = await connection.read_response()
+                if not body:
+                    raise JSONRPCException({"code": -342, "message": "empty HTTP response (status %d)" % status})
+                responses.append(json.loads(body.decode("utf8"), parse_float=decimal.Decimal))
+        except BaseException:
+            connection.close()
+            raise
+        if keep_alive:
+            connection.reused = True
+            self.__idle.append(connection)
+        else:
+            connection.close()
+        return responses
+
+    async def _checkout(self, fresh=False):
+        if self.__idle and not fresh:
+            return self.__idle.pop()
+        context = ssl.create_default_context() if self.__url.scheme == "https" else None
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.__url.hostname, self.__port, ssl=context), self.timeout
+        )
+        return _Connection(reader, writer)
@@ -39,8 +39,10 @@ try:
 except ImportError:
     import httplib
 import base64
+import itertools
 import json
 import decimal
+import threading
 try:
     import urllib.parse as urlparse
 except ImportError:
@@ -50,6 +52,15 @@ USER_AGENT = "AuthServiceProxy/0.1"
 
 HTTP_TIMEOUT = 30
 
+_id_counter = itertools.count(1)
+_id_lock = threading.Lock()
+
+
+def next_request_id():
+    """Return a process-wide unique JSON-RPC request id; safe to call from any thread."""
+    with _id_lock:
+        return next(_id_counter)
+
 
 class JSONRPCException(Exception):
     def __init__(self, rpc_error):
@@ -63,8 +74,6 @@ def EncodeDecimal(o):
     raise TypeError(repr(o) + " is not JSON serializable")
 
 class AuthServiceProxy(object):
-    __id_count = 0
-
     def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, connection=None):
         self.__service_url = service_url
         self.__service_name = service_name
@@ -90,11 +99,10 @@ class AuthServiceProxy(object):
             self.__conn = connection
         elif self.__url.scheme == 'https':
             self.__conn = httplib.HTTPSConnection(self.__url.hostname, port,
-                                                  None, None, False,
-                                                  timeout)
+                                                  timeout=timeout)
         else:
             self.__conn = httplib.HTTPConnection(self.__url.hostname, port,
-                                                 False, timeout)
+                                                 timeout=timeout)
 
     def __getattr__(self, name):
         if name.startswith('__') and name.endswith('__'):
@@ -105,12 +113,10 @@ class AuthServiceProxy(object):
         return AuthServiceProxy(self.__service_url, name, connection=self.__conn)
 
     def __call__(self, *args):
-        AuthServiceProxy.__id_count += 1
-
         postdata = json.dumps({'version': '1.1',
                                'method': self.__service_name,
                                'params': args,
-                               'id': AuthServiceProxy.__id_count}, default=EncodeDecimal)
+                               'id': next_request_id()}, default=EncodeDecimal)
         self.__conn.request('POST', self.__url.path, postdata,
                             {'Host': self.__url.hostname,
                              'User-Agent': USER_AGENT,
@@ -1,10 +1,15 @@
 """WSGI entry point and CLI helpers."""
 from __future__ import annotations
 
+from datetime import timezone
+
 import click
+from sqlalchemy import select
 
 from app import create_app
-from app.database import init_db
+from app.database import db_session, get_redis_client, init_db
+from app.models import CompletedOrder
+from app.services.market import build_candles, store_candles
 
 app = create_app()
 
@@ -16,5 +21,52 @@ def init_database() -> None:
     click.echo("Database initialised")
 
 
+@app.cli.command("backfill-candles")
+@click.option("--instrument", "instruments", multiple=True, help="Trading pair to rebuild (repeatable); defaults to all")
+def backfill_candles(instruments: tuple[str, ...]) -> None:
+    """Rebuild the Redis candles from the trades in completed_orders.
+
+    Every fill is stored once per side, so only the buy rows are counted.
+    Run it while the matching workers are stopped.
+    """
+    settings = app.extensions["settings"]
+    redis = get_redis_client()
+    for instrument in instruments or settings.trading_pairs:
+        spec = settings.instrument(instrument)
+        rows = db_session.execute(
+            select(CompletedOrder.created_at, CompletedOrder.amount, CompletedOrder.price)
+            .where(CompletedOrder.instrument == instrument, CompletedOrder.side == "buy")
+            .order_by(CompletedOrder.created_at, CompletedOrder.id)
+            .execution_options(yield_per=1000)
+        )
+        trades = []
+        for created_at, amount, price in rows:
+            if created_at.tzinfo is None:
+                created_at = created_at.replace(tzinfo=timezone.utc)
+            ticks = spec.to_ticks(price)
+            trades.append((int(created_at.timestamp()), amount, spec.quote_units(amount, ticks), ticks))
+        candles = build_candles(trades)
+        store_candles(redis, instrument, candles)
+        click.echo(f"{instrument}: {len(candles['1m'])} one-minute candles from {len(trades)} trades")
+
+
+@app.cli.command("purge-completed")
+def purge_completed() -> None:
+    """Delete the per-fill ``completed:*`` hashes and indexes replaced by the trade tape."""
+    settings = app.extensions["settings"]
+    redis = get_redis_client()
+    indexes = [f"{instrument}/completed" for instrument in settings.trading_pairs]
+    deleted = redis.unlink(*indexes) if indexes else 0
+    batch = []
+    for key in redis.scan_iter(match="completed:*", count=1000):
+        batch.append(key)
+        if len(batch) == 1000:
+            deleted += redis.unlink(*batch)
+            batch = []
+    if batch:
+        deleted += redis.unlink(*batch)
+    click.echo(f"Deleted {deleted} keys")
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
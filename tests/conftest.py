@@ -9,6 +9,7 @@ import pytest
 
 import app.database as db
 from app import create_app
+from app.services import accounts
 
 
 @pytest.fixture()
@@ -21,6 +22,8 @@ def app(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
 
     fake_redis = fakeredis.FakeStrictRedis(decode_responses=True)
     monkeypatch.setattr(db.redis, "from_url", lambda *args, **kwargs: fake_redis)
+    # Importing ``app`` already created an engine; give every test its own database.
+    monkeypatch.setattr(db, "_engine", None)
 
     application = create_app()
     application.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
@@ -28,8 +31,19 @@ def app(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
     yield application
 
     db.db_session.remove()
+    db._engine.dispose()
 
 
 @pytest.fixture()
 def client(app):
     return app.test_client()
+
+
+@pytest.fixture()
+def make_user(app):
+    settings = app.extensions["settings"]
+
+    def make(name):
+        return accounts.create_user(name, f"{name}@example.com", "supersecret", settings.currencies)
+
+    return make
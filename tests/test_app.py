@@ -1,4 +1,14 @@
-from app.services import accounts
+from decimal import Decimal
+
+import pytest
+from flask import g
+from sqlalchemy import event
+
+from app import database
+from app.database import get_redis_client
+from app.services import accounts, market
+from app.services.matching import Fill
+from app.services.orders import Order, OrderBook
 
 
 def register(client, username="alice", email="alice@example.com", password="supersecret"):
@@ -20,6 +30,15 @@ def test_homepage_accessible(client):
     assert b"Place order" in response.data
 
 
+def test_homepage_market_fragment_is_cached_per_version(client, app):
+    redis = get_redis_client()
+    assert b"No asks yet" in client.get("/").data
+    # Cached fragments are only replaced when the book version moves.
+    OrderBook(redis, app.extensions["settings"]).place_order(Order("ask1", "ltc_btc", "sell", Decimal("0.1"), 100, 1))
+    assert b"0.10000000" in client.get("/").data
+    assert redis.keys("cache:ltc_btc:*:home:market")
+
+
 def test_registration_and_login_flow(client, app):
     register(client)
 
@@ -36,12 +55,98 @@ def test_registration_and_login_flow(client, app):
     assert b"Balances" in account_response.data
 
 
+def test_account_page_loads_user_once(client, app):
+    register(client, "dave", "dave@example.com")
+    client.post("/auth/login", data={"email": "dave@example.com", "password": "supersecret"})
+    # pytest-flask keeps one app context, and so one ``g``, across client requests.
+    g.pop("current_user", None)
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(database._engine, "before_cursor_execute", record)
+    try:
+        assert client.get("/account/").status_code == 200
+    finally:
+        event.remove(database._engine, "before_cursor_execute", record)
+    # The user, its balances and addresses through selectinload, then pending deposits.
+    assert len([statement for statement in statements if statement.lstrip().startswith("SELECT")]) == 4
+
+
 def test_api_endpoints(client):
     assert client.get("/api/volume/ltc_btc").status_code == 200
     assert client.get("/api/high/ltc_btc").json == {"high": 0.0}
     assert client.get("/api/low/ltc_btc").json == {"low": 0.0}
     orders = client.get("/api/orders/ltc_btc/bid").json
     assert isinstance(orders, list)
+    assert client.get("/api/depth/ltc_btc?levels=10").json == {"bids": [], "asks": []}
+    assert client.get("/api/depth/ltc_btc?levels=0").status_code == 400
+
+
+def test_public_endpoints_revalidate_by_book_version(client):
+    first = client.get("/api/depth/ltc_btc")
+    etag = first.headers["ETag"]
+    assert client.get("/api/depth/ltc_btc", headers={"If-None-Match": etag}).status_code == 304
+
+    get_redis_client().incr("ltc_btc/version")
+    refreshed = client.get("/api/depth/ltc_btc", headers={"If-None-Match": etag})
+    assert refreshed.status_code == 200
+    assert refreshed.headers["ETag"] != etag
+    assert refreshed.json == first.json
+
+
+def test_stream_sends_snapshot_then_sequenced_updates(client, app):
+    settings = app.extensions["settings"]
+    redis = get_redis_client()
+    order_book = OrderBook(redis, settings)
+    order_book.place_order(Order("ask1", "ltc_btc", "sell", Decimal("0.1"), 100, 1))
+
+    response = client.get("/api/stream/ltc_btc")
+    chunks = response.iter_encoded()
+    assert next(chunks).startswith(b"event: snapshot\nid: 1\n")
+    order_book.place_order(Order("ask2", "ltc_btc", "sell", Decimal("0.1"), 50, 1))
+    update = next(chunks)
+    assert update.startswith(b"event: update\nid: 2\n")
+    assert b'"amount": 1.5e-06' in update
+    response.close()
+
+    resumed = client.get("/api/stream/ltc_btc", headers={"Last-Event-ID": "1"})
+    assert next(resumed.iter_encoded()).startswith(b"event: update\nid: 2\n")
+    resumed.close()
+
+
+def test_candles_endpoint_serves_stored_candles(client):
+    base = 1_700_000_100
+    candles = market.build_candles(
+        [(base, 100, 10, 10_000_000), (base + 30, 100, 30, 30_000_000), (base + 400, 50, 10, 20_000_000)]
+    )
+    market.store_candles(get_redis_client(), "ltc_btc", candles)
+
+    response = client.get(f"/api/candles/ltc_btc?interval=5m&from={base - 300}&to={base + 600}")
+    assert [(row["open"], row["high"], row["low"], row["close"]) for row in response.json] == [
+        (0.1, 0.3, 0.1, 0.3),
+        (0.2, 0.2, 0.2, 0.2),
+    ]
+    assert response.json[0]["base_currency_volume"] == 2e-06
+    assert client.get("/api/candles/ltc_btc?interval=2m").status_code == 400
+
+
+def test_trades_endpoint_pages_back_through_the_tape(client):
+    redis = get_redis_client()
+    feed = market.MarketFeed(["ltc_btc"])
+    for index, price in enumerate((10_000_000, 20_000_000, 30_000_000)):
+        feed.record_fill("ltc_btc", Fill("b", "a", 1, 2, "buy", price, 100, 0, price), 10, now=1_700_000_000 + index)
+    pipe = redis.pipeline()
+    feed.publish(pipe, now=1_700_000_100)
+    pipe.execute()
+
+    page = client.get("/api/trades/ltc_btc?limit=2").json
+    assert [trade["price"] for trade in page["trades"]] == [0.3, 0.2]
+    older = client.get(f"/api/trades/ltc_btc?limit=2&before={page['next']}").json
+    assert [trade["price"] for trade in older["trades"]] == [0.1]
+    assert older["next"] is None
+    assert client.get("/api/trades/ltc_btc?before=latest").status_code == 400
 
 
 def test_order_requires_authentication(client):
@@ -82,3 +187,37 @@ def test_balance_updates_on_order_submission(client, app):
         follow_redirects=True,
     )
     assert b"Order placed" in response.data
+
+
+def test_withdrawals_below_the_minimum_are_refused(client, app):
+    register(client, "wendy", "wendy@example.com")
+    client.post("/auth/login", data={"email": "wendy@example.com", "password": "supersecret"})
+    user = accounts.authenticate_user("wendy@example.com", "supersecret")
+    accounts.change_balance(user, "ltc", 100_000_000)
+
+    response = client.post(
+        "/account/withdraw", data={"currency": "ltc", "address": "dust", "amount": "0.00000001"}, follow_redirects=True
+    )
+    assert b"minimum withdrawal is 0.001 LTC" in response.data
+    database.db_session.expire(user, ["balances"])
+    assert user.balance_for("ltc") == 100_000_000
+
+
+def test_apply_balance_changes_reports_rejected_rows(make_user):
+    user = make_user("carol")
+    assert user.balance_for("ltc") == 0
+
+    overdraw = accounts.BalanceChange(user.id, "btc", -5)
+    unknown = accounts.BalanceChange(user.id, "xyz", 5)
+    rejected = accounts.apply_balance_changes(
+        [accounts.BalanceChange(user.id, "ltc", 10), overdraw, unknown, accounts.BalanceChange(user.id, "ltc", -4)]
+    )
+    assert rejected == [unknown, overdraw]
+    assert user.balance_for("ltc") == 6
+    assert user.balance_for("btc") == 0
+    with pytest.raises(accounts.AccountError, match="Insufficient"):
+        accounts.change_balance(user, "ltc", -7)
+
+    assert accounts.apply_balance_changes([unknown], create_missing=True) == []
+    database.db_session.expire(user, ["balances"])
+    assert user.balance_for("xyz") == 5
@@ -0,0 +1,203 @@
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+from click.testing import CliRunner
+from sqlalchemy.exc import IntegrityError
+
+from app import depositor, notify
+from app.database import db_session, get_redis_client
+from app.models import Address, CompletedOrder, DepositCursor, PendingDeposit
+from app.services import accounts
+from app.services.notify import Notification, fetch_notifications
+
+
+class FakeRegistry:
+    def __init__(self, listings, confirmations=None):
+        self.listings = listings
+        self.confirmations = confirmations or {}
+        self.calls = []
+        self.lookups = []
+
+    def list_since_block(self, currency, block_hash=None, target_confirmations=1):
+        self.calls.append((currency, block_hash, target_confirmations))
+        return self.listings.pop(0)
+
+    def get_transactions(self, currency, txids):
+        self.lookups.append(list(txids))
+        return {txid: {"confirmations": self.confirmations[txid]} for txid in txids if txid in self.confirmations}
+
+
+@pytest.fixture()
+def depositor_user(app, make_user):
+    user = make_user("erin")
+    db_session.add(Address(user_id=user.id, currency="ltc", address="ltc-erin"))
+    db_session.commit()
+    return app.extensions["settings"], user, "ltc-erin"
+
+
+def receive(txid, address, amount, confirmations=6):
+    return {"category": "receive", "txid": txid, "address": address, "amount": amount, "confirmations": confirmations}
+
+
+def test_depositor_resumes_from_block_cursor(depositor_user):
+    settings, user, address = depositor_user
+    txid = uuid.uuid4().hex
+    registry = FakeRegistry(
+        [
+            {"transactions": [receive(txid, address, 1.5)], "lastblock": "block-1"},
+            {"transactions": [receive(txid, address, 1.5)], "lastblock": "block-2"},
+        ]
+    )
+    depositor._process_currency(registry, settings, "ltc")
+    depositor._process_currency(registry, settings, "ltc")
+
+    assert [call[1] for call in registry.calls] == [None, "block-1"]
+    assert db_session.get(DepositCursor, "ltc").block_hash == "block-2"
+    db_session.expire_all()
+    assert user.balance_for("ltc") == 150_000_000
+
+
+def test_unconfirmed_deposits_are_tracked_until_confirmed(depositor_user):
+    settings, user, address = depositor_user
+    txid = uuid.uuid4().hex
+    registry = FakeRegistry(
+        [
+            {"transactions": [receive(txid, address, 2, confirmations=0)], "lastblock": "tip-1"},
+            {"transactions": [], "lastblock": "tip-2"},
+            {"transactions": [], "lastblock": "tip-3"},
+        ]
+    )
+    depositor._process_currency(registry, settings, "ltc")
+    assert accounts.get_pending_deposits(user) == {"ltc": 200_000_000}
+
+    registry.confirmations[txid] = 0
+    depositor._process_currency(registry, settings, "ltc")
+    registry.confirmations[txid] = 6
+    depositor._process_currency(registry, settings, "ltc")
+
+    assert registry.lookups == [[txid], [txid]]
+    assert db_session.query(PendingDeposit).filter_by(transaction_id=txid).count() == 0
+    db_session.expire_all()
+    assert user.balance_for("ltc") == 200_000_000
+
+
+def test_poll_credits_in_one_transaction_and_index_rejects_repeats(depositor_user):
+    settings, user, address = depositor_user
+    first, second = uuid.uuid4().hex, uuid.uuid4().hex
+    registry = FakeRegistry(
+        [{"transactions": [receive(first, address, 1), receive(second, address, 2)], "lastblock": "tip"}]
+    )
+    depositor._process_currency(registry, settings, "ltc")
+    db_session.expire_all()
+    assert user.balance_for("ltc") == 300_000_000
+
+    repeat = CompletedOrder(
+        user_id=user.id,
+        instrument="ltc_ltc",
+        side="DEPOSIT",
+        base_currency="ltc",
+        quote_currency="ltc",
+        amount=1,
+        price=0,
+        is_deposit=True,
+        deposit_address=address,
+        transaction_id=first,
+    )
+    db_session.add(repeat)
+    with pytest.raises(IntegrityError):
+        db_session.commit()
+    db_session.rollback()
+
+
+def test_transaction_paying_several_addresses_credits_each(depositor_user, make_user):
+    settings, user, address = depositor_user
+    other = make_user("otto")
+    other_address = "ltc-otto"
+    db_session.add(Address(user_id=other.id, currency="ltc", address=other_address))
+    db_session.commit()
+    txid = uuid.uuid4().hex
+    outputs = [receive(txid, address, 1), receive(txid, other_address, 2, confirmations=0), receive(txid, address, 0.5)]
+    registry = FakeRegistry(
+        [{"transactions": outputs, "lastblock": "tip-1"}, {"transactions": outputs, "lastblock": "tip-2"}],
+        confirmations={txid: 6},
+    )
+    depositor._process_currency(registry, settings, "ltc")
+    assert accounts.get_pending_deposits(other) == {"ltc": 200_000_000}
+    depositor._process_currency(registry, settings, "ltc")
+
+    db_session.expire_all()
+    assert user.balance_for("ltc") == 150_000_000
+    assert other.balance_for("ltc") == 200_000_000
+    assert db_session.query(CompletedOrder).filter_by(transaction_id=txid).count() == 2
+
+
+def test_slow_wallet_does_not_hold_back_other_currencies(depositor_user):
+    settings, user, address = depositor_user
+    txid = uuid.uuid4().hex
+    release = threading.Event()
+
+    class SlowBitcoin(FakeRegistry):
+        def list_since_block(self, currency, block_hash=None, target_confirmations=1):
+            if currency == "btc":
+                release.wait(5)
+                return {"transactions": [], "lastblock": "btc-tip"}
+            if currency == "ltc":
+                return {"transactions": [receive(txid, address, 1)], "lastblock": "ltc-tip"}
+            return {}
+
+    registry = SlowBitcoin([])
+    inflight = {}
+    with ThreadPoolExecutor(max_workers=len(settings.currencies)) as executor:
+        depositor._poll_all(registry, settings, executor, inflight, deadline=0.5)
+        db_session.expire_all()
+        assert user.balance_for("ltc") == 100_000_000
+        assert list(inflight) == ["btc"]
+
+        release.set()
+        depositor._poll_all(registry, settings, executor, inflight, deadline=5)
+    assert inflight == {}
+    assert db_session.get(DepositCursor, "btc").block_hash == "btc-tip"
+
+
+def test_walletnotify_hook_credits_the_notified_transaction(depositor_user):
+    settings, user, address = depositor_user
+    txid = uuid.uuid4().hex
+    assert CliRunner().invoke(notify.main, ["ltc", "--tx", txid]).exit_code == 0
+    assert CliRunner().invoke(notify.main, ["xyz", "--tx", txid]).exit_code != 0
+
+    class Notified(FakeRegistry):
+        def get_transactions(self, currency, txids):
+            self.lookups.append(list(txids))
+            self.threads.append(threading.current_thread())
+            return {
+                txid: {"confirmations": 6, "details": [{"category": "receive", "address": address, "amount": 0.25}]}
+                for txid in txids
+            }
+
+    registry = Notified([])
+    registry.threads = []
+    notifications = fetch_notifications(get_redis_client(), timeout=1)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        depositor._handle_notifications(registry, settings, executor, {}, 1, notifications)
+
+    assert registry.lookups == [[txid]]
+    assert threading.main_thread() not in registry.threads
+    assert registry.calls == []
+    db_session.expire_all()
+    assert user.balance_for("ltc") == 25_000_000
+
+
+def test_notified_txids_wait_for_a_busy_wallet(depositor_user):
+    settings, user, address = depositor_user
+    txid = uuid.uuid4().hex
+    redis = get_redis_client()
+    registry = FakeRegistry([])
+    busy = {"ltc": Future()}
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        depositor._handle_notifications(registry, settings, executor, busy, 0.1, [Notification("ltc", txid)])
+
+    assert registry.lookups == []
+    assert list(busy) == ["ltc"]
+    assert fetch_notifications(redis, timeout=1) == [Notification("ltc", txid)]
@@ -0,0 +1,148 @@
+import asyncio
+import json
+import threading
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app.rpc import Wallet, WalletError, WalletRegistry
+from bitcoinrpc.asyncproxy import AsyncServiceProxy
+from bitcoinrpc.authproxy import JSONRPCException, next_request_id
+
+
+class StubDaemon(BaseHTTPRequestHandler):
+    """Answers JSON-RPC like a wallet daemon, optionally dropping idle keep-alive sockets."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        server.requests += 1
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        body = json.dumps([self.answer(call) for call in payload] if isinstance(payload, list) else self.answer(payload))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode())
+        # Closing without a "Connection: close" header leaves the client holding a stale socket.
+        self.close_connection = server.drop_connections
+
+    def answer(self, call):
+        method, params = call["method"], call["params"]
+        if method == "gettransaction" and params[0] == "missing":
+            return {"id": call["id"], "result": None, "error": {"code": -5, "message": "Invalid or non-wallet transaction id"}}
+        if method == "gettransaction":
+            return {"id": call["id"], "result": {"txid": params[0], "amount": 0.5, "confirmations": 3}, "error": None}
+        if method == "listtransactions":
+            # Pages count back from the newest transaction, each listed oldest first.
+            count, skip = params[1], params[2]
+            end = len(self.server.transactions) - skip
+            return {"id": call["id"], "result": self.server.transactions[max(end - count, 0) : max(end, 0)], "error": None}
+        return {"id": call["id"], "result": {"method": method, "params": params}, "error": None}
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def daemon():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubDaemon)
+    server.requests = server.connections = 0
+    server.drop_connections = False
+    server.transactions = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def wallet_for(daemon):
+    host, port = daemon.server_address
+    return Wallet("ltc", "Litecoin", f"http://user:secret@{host}:{port}/", 5)
+
+
+def test_batched_calls_share_one_kept_alive_connection(daemon):
+    wallet = wallet_for(daemon)
+    results = wallet.call_many([("gettransaction", ["a"]), ("gettransaction", ["missing"]), ("getblockcount", [])])
+    assert results[0]["amount"] == Decimal("0.5")
+    assert isinstance(results[1], WalletError)
+    assert wallet.call("listsinceblock", "", 1)["method"] == "listsinceblock"
+    assert (daemon.requests, daemon.connections) == (2, 1)
+
+
+def test_stale_connection_is_replaced_transparently(daemon, app):
+    wallet = wallet_for(daemon)
+    registry = WalletRegistry(app.extensions["settings"])
+    registry._wallets["ltc"] = wallet
+    daemon.drop_connections = True
+    assert registry.get_transactions("ltc", ["a", "missing"]) == {"a": {"txid": "a", "amount": Decimal("0.5"), "confirmations": 3}}
+    assert registry.list_since_block("ltc")["params"] == ["", 1]
+    assert (daemon.requests, daemon.connections) == (2, 2)
+
+
+def test_async_client_pipelines_and_batches_on_kept_alive_connections(daemon):
+    host, port = daemon.server_address
+
+    async def scenario():
+        async with AsyncServiceProxy(f"http://user:secret@{host}:{port}/", timeout=5, max_connections=2) as proxy:
+            transaction = await proxy.call("gettransaction", "a")
+            pipelined = await proxy.pipeline([("getblockcount", []), ("gettransaction", ["missing"])])
+            batch = await proxy.batch([{"version": "1.1", "method": "getblockcount", "params": [], "id": 7}])
+            concurrent = await asyncio.gather(*(proxy.call("getblockcount") for _ in range(6)))
+            return transaction, pipelined, batch, concurrent
+
+    transaction, pipelined, batch, concurrent = asyncio.run(scenario())
+    assert transaction["amount"] == Decimal("0.5")
+    assert pipelined[0]["method"] == "getblockcount"
+    assert isinstance(pipelined[1], JSONRPCException)
+    assert batch[0]["id"] == 7
+    assert len(concurrent) == 6
+    assert daemon.requests == 10
+    assert daemon.connections <= 2
+
+
+def test_async_registry_reconnects_after_the_daemon_drops_idle_sockets(daemon, app):
+    registry = WalletRegistry(app.extensions["settings"])
+    registry._wallets["ltc"] = wallet_for(daemon)
+    daemon.drop_connections = True
+
+    async def scenario():
+        try:
+            listing = await registry.list_since_block_async("ltc", "abc")
+            details = await registry.get_transactions_async("ltc", ["a", "missing"])
+        finally:
+            await registry.close_async()
+        return listing, details
+
+    listing, details = asyncio.run(scenario())
+    assert listing["params"] == ["abc", 1]
+    assert list(details) == ["a"]
+    assert (daemon.requests, daemon.connections) == (2, 2)
+
+
+def test_request_ids_are_unique_across_threads():
+    ids = []
+    threads = [threading.Thread(target=lambda: ids.extend(next_request_id() for _ in range(1000))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(ids)) == 4000
+
+
+def test_sent_transaction_is_found_past_the_first_page(daemon, app):
+    registry = WalletRegistry(app.extensions["settings"])
+    registry._wallets["ltc"] = wallet_for(daemon)
+    payment = {"category": "send", "txid": "paid", "comment": "withdrawal-batch:7", "time": 1_000}
+    daemon.transactions = [payment] + [{"category": "receive", "txid": f"r{n}", "time": 2_000 + n} for n in range(450)]
+    assert registry.find_sent_transaction("ltc", "withdrawal-batch:7", since=900, page_size=100) == "paid"
+    assert daemon.requests == 5
+    assert registry.find_sent_transaction("ltc", "withdrawal-batch:8", since=2_300, page_size=100) is None
+    assert daemon.requests == 7
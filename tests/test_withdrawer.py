@@ -0,0 +1,99 @@
+import uuid
+from decimal import Decimal
+
+import pytest
+
+from app import withdrawer
+from app.database import db_session
+from app.models import CompletedOrder, WithdrawalBatch
+from app.rpc import WalletError, WalletRejected
+
+
+class FakeWallet:
+    def __init__(self, fail_with=None, refuses=()):
+        self.payments = []
+        self.sent = {}
+        self.fail_with = fail_with
+        self.refuses = refuses
+
+    def validate_addresses(self, currency, addresses):
+        return {address: not address.startswith("bad") for address in addresses}
+
+    def send_many(self, currency, amounts, comment):
+        if any(address in self.refuses for address in amounts):
+            raise WalletRejected("Transaction amount too small")
+        self.payments.append(amounts)
+        txid = uuid.uuid4().hex
+        self.sent[comment] = txid
+        if self.fail_with:
+            raise self.fail_with
+        return txid
+
+    def find_sent_transaction(self, currency, comment, since):
+        return self.sent.get(comment)
+
+    def get_transactions(self, currency, txids):
+        return {txid: {"confirmations": 0} for txid in txids if txid in self.sent.values()}
+
+
+@pytest.fixture()
+def withdrawals(app, make_user):
+    user = make_user("fred")
+    orders = [
+        CompletedOrder(
+            user_id=user.id,
+            instrument="ltc_ltc",
+            side="WITHDRAW",
+            base_currency="ltc",
+            quote_currency="ltc",
+            amount=amount,
+            price=Decimal("0"),
+            is_withdrawal=True,
+            withdrawal_address=address,
+        )
+        for address, amount in (("a", 100), ("a", 50), ("b", 25), ("bad", 10))
+    ]
+    db_session.add_all(orders)
+    db_session.commit()
+    return app.extensions["settings"], user, orders
+
+
+def test_withdrawals_are_paid_with_one_sendmany(withdrawals):
+    settings, user, orders = withdrawals
+    wallet = FakeWallet()
+    withdrawer._process_currency(wallet, settings, "ltc", window=0, max_outputs=500)
+
+    assert wallet.payments == [{"a": Decimal("0.0000015"), "b": Decimal("0.00000025")}]
+    db_session.expire_all()
+    assert len({order.transaction_id for order in orders[:3]}) == 1
+    assert orders[0].transaction_id is not None
+    assert orders[3].side == "REFUND" and orders[3].transaction_id is None
+    assert user.balance_for("ltc") == 10
+
+
+def test_interrupted_batch_is_not_paid_twice(withdrawals):
+    settings, user, orders = withdrawals
+    wallet = FakeWallet(fail_with=WalletError("connection reset"))
+    withdrawer._process_currency(wallet, settings, "ltc", window=0, max_outputs=500)
+    batch = db_session.get(WithdrawalBatch, orders[0].withdrawal_batch_id)
+    assert batch.status == "sending"
+
+    wallet.fail_with = None
+    withdrawer._process_currency(wallet, settings, "ltc", window=0, max_outputs=500)
+    assert len(wallet.payments) == 1
+    db_session.expire_all()
+    assert batch.status == "sent"
+    assert orders[0].transaction_id == wallet.sent[batch.comment]
+
+
+def test_refused_batch_is_split_and_the_unpayable_address_refunded(withdrawals):
+    settings, user, orders = withdrawals
+    wallet = FakeWallet(refuses={"b"})
+    for _ in range(3):
+        withdrawer._process_currency(wallet, settings, "ltc", window=0, max_outputs=500)
+
+    assert wallet.payments == [{"a": Decimal("0.0000015")}]
+    db_session.expire_all()
+    assert orders[0].transaction_id is not None and orders[1].transaction_id == orders[0].transaction_id
+    assert orders[2].side == "REFUND" and orders[2].transaction_id is None
+    assert user.balance_for("ltc") == 35
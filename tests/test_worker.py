@@ -0,0 +1,318 @@
+import time
+from dataclasses import replace
+from datetime import datetime, timezone
+from decimal import Decimal
+from types import SimpleNamespace
+
+import click
+import pytest
+from click.testing import CliRunner
+
+from app import supervisor, worker
+from app.database import db_session, get_redis_client
+from app.services import accounts
+from app.services.cache import get_version
+from app.services.depth import read_depth
+from app.services.ledger import SettlementLedger
+from app.services.market import CANDLE_INTERVALS, MarketFeed, TickerStats, read_candles, read_ticker
+from app.services.matching import Fill, MatchingEngine, RestingOrder, ScriptedMatcher
+from app.services.orders import Order, OrderBook
+from app.services.queues import StreamOrderQueue, migrate_legacy_queue, order_queue
+
+
+@pytest.fixture()
+def market(app, make_user):
+    return app.extensions["settings"], get_redis_client(), make_user("alice"), make_user("bob")
+
+
+def place(settings, redis, order_id, user, side, price, amount):
+    OrderBook(redis, settings).place_order(
+        Order(id=order_id, instrument="ltc_btc", side=side, price=Decimal(price), amount=amount, user_id=user.id)
+    )
+
+
+def drain(settings, engine, redis):
+    ledger = SettlementLedger(redis, settings)
+    feed = MarketFeed(settings.trading_pairs)
+    while worker._process_once(
+        settings, engine, ledger, feed, redis, order_queue(redis, settings, settings.trading_pairs)
+    ):
+        pass
+
+
+def test_engine_keeps_price_time_priority():
+    engine = MatchingEngine(["ltc_btc"])
+    engine.add(RestingOrder("a1", "ltc_btc", "sell", 20_000_000, 100, 1))
+    engine.add(RestingOrder("a2", "ltc_btc", "sell", 10_000_000, 100, 2))
+    engine.add(RestingOrder("a3", "ltc_btc", "sell", 10_000_000, 100, 3))
+    result = engine.match(RestingOrder("b1", "ltc_btc", "buy", 20_000_000, 250, 4))
+    assert [(fill.maker_id, fill.amount) for fill in result.fills] == [("a2", 100), ("a3", 100), ("a1", 50)]
+    assert result.remaining == 0
+    assert engine.find("a1").amount == 50
+    assert engine.find("a2") is None
+
+
+@pytest.mark.parametrize("engine_name", ["memory", "lua"])
+def test_worker_matches_and_settles(market, engine_name):
+    settings, redis, alice, bob = market
+    multiplier = settings.currency("ltc").multiplier
+    if engine_name == "lua":
+        engine = ScriptedMatcher(redis, settings)
+    else:
+        engine = MatchingEngine(settings.trading_pairs)
+    place(settings, redis, "ask1", alice, "sell", "0.1", 2 * multiplier)
+    place(settings, redis, "bid1", bob, "buy", "0.1", multiplier)
+    drain(settings, engine, redis)
+
+    db_session.expire_all()
+    assert alice.balance_for("btc") == multiplier // 10
+    assert bob.balance_for("ltc") == multiplier
+    assert redis.hget("ask1", "amount") == str(multiplier)
+    assert not redis.exists("bid1")
+    assert redis.zrange("ltc_btc/bid", 0, -1) == []
+    assert not redis.exists("ltc_btc/completed")
+    tape = OrderBook(redis, settings).get_trades("ltc_btc", 10)
+    assert [(trade["price"], trade["amount"]) for trade in tape["trades"]] == [(0.1, 1.0)]
+    assert OrderBook(redis, settings).get_volume("ltc_btc")["base_currency_volume"] == 1.0
+    assert read_depth(redis, "ltc_btc", 5) == {"bid": [], "ask": [(10_000_000, multiplier)]}
+
+
+@pytest.mark.parametrize("engine_name", ["memory", "lua"])
+def test_orders_of_unknown_users_are_removed_from_the_book(market, engine_name):
+    settings, redis, alice, bob = market
+    engine = ScriptedMatcher(redis, settings) if engine_name == "lua" else MatchingEngine(settings.trading_pairs)
+    place(settings, redis, "ghost1", SimpleNamespace(id=10**9), "sell", "0.1", 100)
+    assert read_depth(redis, "ltc_btc", 5)["ask"] == [(10_000_000, 100)]
+    drain(settings, engine, redis)
+
+    assert not redis.exists("ghost1")
+    assert redis.zrange("ltc_btc/ask", 0, -1) == []
+    assert not redis.sismember(f"{10**9}/orders", "ghost1")
+    assert read_depth(redis, "ltc_btc", 5) == {"bid": [], "ask": []}
+
+
+def test_engine_rebuilds_from_redis_and_cancels(market):
+    settings, redis, alice, bob = market
+    multiplier = settings.currency("ltc").multiplier
+    place(settings, redis, "ask1", alice, "sell", "0.1", multiplier)
+    drain(settings, MatchingEngine(settings.trading_pairs), redis)
+
+    engine = MatchingEngine()
+    assert engine.load(redis, settings, settings.trading_pairs) == 1
+    OrderBook(redis, settings).cancel_order("ask1", alice.id)
+    drain(settings, engine, redis)
+
+    db_session.expire_all()
+    assert alice.balance_for("ltc") == multiplier
+    assert read_depth(redis, "ltc_btc", 5) == {"bid": [], "ask": []}
+    assert engine.find("ask1") is None
+    assert not redis.exists("ask1")
+
+
+def test_orders_are_queued_per_instrument(market):
+    settings, redis, alice, bob = market
+    place(settings, redis, "ask1", alice, "sell", "0.1", 100)
+    assert OrderBook(redis, settings).cancel_order("ask1", alice.id)
+    assert redis.lrange("order_queue:ltc_btc", 0, -1) == ["ask1", "cancel:ask1"]
+    assert not redis.exists("order_queue")
+
+
+def test_supervisor_forwards_worker_options():
+    command = supervisor._worker_command(["ltc_btc"], ["--engine", "memory", "--batch-size", "200"])
+    assert command[1:] == ["-m", "app.worker", "--engine", "memory", "--batch-size", "200", "--instrument", "ltc_btc"]
+
+
+@pytest.mark.parametrize("command", [worker.main, supervisor.main])
+def test_lua_engine_is_refused_with_stream_ingestion(app, monkeypatch, command):
+    monkeypatch.setenv("ORDER_INGEST", "stream")
+    result = CliRunner().invoke(command, ["--engine", "lua"])
+    assert result.exit_code == 2
+    assert "ORDER_INGEST=stream" in result.output
+
+
+@pytest.mark.parametrize("ingest", ["list", "stream"])
+def test_worker_moves_legacy_queue_items(market, ingest):
+    settings, redis, alice, bob = market
+    settings.order_ingest = ingest
+    place(settings, redis, "ask1", alice, "sell", "0.1", 100)
+    queue = order_queue(redis, settings, settings.trading_pairs)
+    queue.reclaim()
+    queue.fetch(10)
+    # Items queued by the old web tier; its cancels only name the order they cancel.
+    redis.hset("legacy-cancel", mapping={"ordertype": "cancel", "uid": alice.id, "old_order_id": "ask1"})
+    redis.rpush("order_queue", "legacy-cancel", "gone")
+    assert migrate_legacy_queue(redis, settings) == 1
+    assert not redis.exists("order_queue")
+    assert [item.order_id for item in queue.fetch(10)] == ["legacy-cancel"]
+
+
+def test_supervisor_groups_unassigned_pairs_individually():
+    pairs = ["ltc_btc", "bch_btc", "doge_btc"]
+    assert supervisor._plan_groups(("ltc_btc,doge_btc",), pairs) == [["ltc_btc", "doge_btc"], ["bch_btc"]]
+    with pytest.raises(click.BadParameter):
+        supervisor._plan_groups(("ltc_btc", "ltc_btc,bch_btc"), pairs)
+
+
+def test_batch_settles_several_orders_in_one_pass(market):
+    settings, redis, alice, bob = market
+    engine = MatchingEngine(settings.trading_pairs)
+    queue = order_queue(redis, settings, settings.trading_pairs)
+    place(settings, redis, "ask1", alice, "sell", "0.1", 100)
+    place(settings, redis, "ask2", alice, "sell", "0.2", 100)
+    place(settings, redis, "bid1", bob, "buy", "0.2", 150)
+
+    assert get_version(redis, "ltc_btc") == 3
+    assert worker._process_once(settings, engine, SettlementLedger(redis, settings), MarketFeed(settings.trading_pairs), redis, queue, batch_size=10) == 3
+    assert get_version(redis, "ltc_btc") == 4
+    assert redis.llen("order_queue:ltc_btc") == 0
+    assert redis.hget("ask2", "amount") == "50"
+    # The buy executes at its own limit, but depth is released at each maker's price.
+    assert read_depth(redis, "ltc_btc", 5) == {"bid": [], "ask": [(20_000_000, 50)]}
+    db_session.expire_all()
+    assert bob.balance_for("ltc") == 150
+    trades = accounts.get_trade_history(bob, "ltc")
+    assert sorted((trade.side, trade.amount, trade.price) for trade in trades) == [
+        ("buy", 50, Decimal("0.2")),
+        ("buy", 100, Decimal("0.2")),
+    ]
+
+
+def test_batch_skips_orders_closed_earlier_in_the_batch(market):
+    settings, redis, alice, bob = market
+    place(settings, redis, "ask1", alice, "sell", "0.1", 100)
+    place(settings, redis, "bid1", bob, "buy", "0.1", 100)
+    place(settings, redis, "ask2", alice, "sell", "0.3", 100)
+    OrderBook(redis, settings).cancel_order("ask2", alice.id)
+    # A restarted worker loads queued orders with the book, so ask1 fills bid1 before bid1's own item.
+    engine = MatchingEngine()
+    engine.load(redis, settings, settings.trading_pairs)
+    queue = order_queue(redis, settings, settings.trading_pairs)
+    ledger, feed = SettlementLedger(redis, settings), MarketFeed(settings.trading_pairs)
+    assert worker._process_once(settings, engine, ledger, feed, redis, queue, batch_size=10) == 4
+
+    db_session.expire_all()
+    assert bob.balance_for("ltc") == 100
+    assert alice.balance_for("ltc") == 100  # only the cancelled ask2 is refunded
+    assert engine.find("bid1") is None and engine.find("ask2") is None
+    assert not redis.exists("bid1") and not redis.exists("ask2")
+    assert read_depth(redis, "ltc_btc", 5) == {"bid": [], "ask": []}
+
+
+def test_stream_ingestion_resumes_unacknowledged_entries(market):
+    settings, redis, alice, bob = market
+    settings.order_ingest = "stream"
+    engine = MatchingEngine(settings.trading_pairs)
+    place(settings, redis, "ask1", alice, "sell", "0.1", 100)
+    place(settings, redis, "bid1", bob, "buy", "0.1", 100)
+
+    crashed = StreamOrderQueue(redis, settings.trading_pairs, consumer="crashed")
+    assert [item.order_id for item in crashed.fetch(10)] == ["ask1", "bid1"]
+
+    queue = StreamOrderQueue(redis, settings.trading_pairs, consumer="restarted")
+    assert worker._resume(settings, engine, SettlementLedger(redis, settings), MarketFeed(settings.trading_pairs), redis, queue, batch_size=10) == 2
+    assert redis.xpending("order_stream:ltc_btc", queue.group)["pending"] == 0
+    assert queue.fetch(10, max_latency_ms=0) == []
+    db_session.expire_all()
+    assert bob.balance_for("ltc") == 100
+
+
+def test_ledger_replays_journal_after_crash(market):
+    settings, redis, alice, bob = market
+    engine = MatchingEngine(settings.trading_pairs)
+    queue = order_queue(redis, settings, settings.trading_pairs)
+    place(settings, redis, "ask1", alice, "sell", "0.1", 100)
+    place(settings, redis, "bid1", bob, "buy", "0.1", 100)
+
+    # The batch is published to Redis but the worker dies before flushing.
+    crashed = SettlementLedger(redis, settings, flush_interval_ms=60_000)
+    assert worker._process_once(settings, engine, crashed, MarketFeed(settings.trading_pairs), redis, queue, batch_size=10) == 2
+    assert crashed.has_pending
+    crashed_at = datetime.now(timezone.utc).replace(tzinfo=None)
+    db_session.expire_all()
+    assert bob.balance_for("ltc") == 0
+
+    restarted = SettlementLedger(redis, settings)
+    assert restarted.recover(settings.trading_pairs) == 1
+    assert restarted.recover(settings.trading_pairs) == 0
+    db_session.expire_all()
+    assert bob.balance_for("ltc") == 100
+    assert alice.balance_for("btc") == 10
+    # Replayed trades keep the time they were filled at, not the time of the flush.
+    assert [trade.created_at <= crashed_at for trade in accounts.get_trade_history(bob, "ltc")] == [True]
+
+
+def test_ticker_covers_only_the_last_24_hours(market):
+    settings, redis, alice, bob = market
+    spec = settings.instrument("ltc_btc")
+    feed = MarketFeed(["ltc_btc"])
+    now = 1_700_000_000
+    fill = Fill("b1", "a1", bob.id, alice.id, "buy", spec.to_ticks(Decimal("0.3")), 100, 0, spec.to_ticks(Decimal("0.3")))
+    feed.record_fill("ltc_btc", fill, 30, now=now - 23 * 3600)
+    feed.record_fill("ltc_btc", replace(fill, price=spec.to_ticks(Decimal("0.1"))), 10, now=now - 60)
+    pipe = redis.pipeline()
+    feed.publish(pipe, now=now)
+    pipe.execute()
+    assert read_ticker(redis, "ltc_btc", now=now) == TickerStats(base=200, quote=40, high=30_000_000, low=10_000_000)
+    assert [candle.close for candle in read_candles(redis, "ltc_btc", "1m", 0, now, 10)] == [30_000_000, 10_000_000]
+
+    pipe = redis.pipeline()
+    feed.publish(pipe, now=now + 3600)
+    pipe.execute()
+    assert read_ticker(redis, "ltc_btc", now=now + 3600) == TickerStats(base=100, quote=10, high=10_000_000, low=10_000_000)
+
+    # An idle minute rollover keeps the summary fresh without a new version or event.
+    version = get_version(redis, "ltc_btc")
+    pipe = redis.pipeline()
+    assert feed.publish(pipe, now=now + 3660) == set()
+    pipe.execute()
+    assert get_version(redis, "ltc_btc") == version
+    assert read_ticker(redis, "ltc_btc", now=now + 3660).base == 100
+
+
+def test_backfilled_candles_match_the_live_ones(market):
+    settings, redis, alice, bob = market
+    place(settings, redis, "ask1", alice, "sell", "0.1", 100)
+    place(settings, redis, "ask2", alice, "sell", "0.2", 100)
+    place(settings, redis, "bid1", bob, "buy", "0.3", 150)
+    place(settings, redis, "bid2", bob, "buy", "0.05", 50)
+    place(settings, redis, "ask3", alice, "sell", "0.05", 70)
+    drain(settings, MatchingEngine(settings.trading_pairs), redis)
+    live = {interval: read_candles(redis, "ltc_btc", interval, 0, time.time(), 10) for interval in CANDLE_INTERVALS}
+    assert sum(candle.base for candle in live["1d"]) == 200
+
+    import run  # creates its app on import, so only once the test app has configured the environment
+
+    assert run.app.test_cli_runner().invoke(args=["backfill-candles", "--instrument", "ltc_btc"]).exit_code == 0
+    assert {interval: read_candles(redis, "ltc_btc", interval, 0, time.time(), 10) for interval in CANDLE_INTERVALS} == live
+
+
+def test_engine_upgrades_decimal_prices_to_ticks(market):
+    settings, redis, alice, bob = market
+    redis.hset("legacy", mapping={"instrument": "ltc_btc", "ordertype": "sell", "amount": 5, "uid": alice.id, "price": "0.1"})
+    redis.zadd("ltc_btc/ask", {"legacy": 0.1})
+
+    engine = MatchingEngine()
+    engine.load(redis, settings, ["ltc_btc"])
+    assert engine.find("legacy").price == 10_000_000
+    assert redis.hget("legacy", "price") == "10000000"
+    assert redis.zscore("ltc_btc/ask", "legacy") == 10_000_000
+
+
+def test_engine_upgrades_integer_valued_legacy_prices(market):
+    settings, redis, alice, bob = market
+    # One whole BTC per LTC, stored by the old web tier as str(Decimal("1")).
+    redis.hset("legacy", mapping={"instrument": "ltc_btc", "ordertype": "sell", "amount": 5, "uid": alice.id, "price": "1"})
+    redis.zadd("ltc_btc/ask", {"legacy": 1.0})
+
+    engine = MatchingEngine()
+    engine.load(redis, settings, ["ltc_btc"])
+    assert engine.find("legacy").price == 100_000_000
+    assert redis.hmget("legacy", "price", "ticks") == ["100000000", "1"]
+    assert redis.zscore("ltc_btc/ask", "legacy") == 100_000_000
+
+
+def test_quote_units_round_half_even_like_decimal(app):
+    spec = app.extensions["settings"].instrument("ltc_btc")
+    for amount, price in [(150, "0.2"), (5, "0.1"), (15, "0.1"), (123_456_789, "0.00012345"), (1, "0.5")]:
+        expected = int((Decimal(amount) / 100_000_000 * Decimal(price) * 100_000_000).quantize(Decimal(1)))
+        assert spec.quote_units(amount, spec.to_ticks(Decimal(price))) == expected